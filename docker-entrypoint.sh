@@ -40,9 +40,9 @@ then
 			then
 				CONDITIONALS="${CONDITIONALS} --trace-memory"
 			fi
-			if [ ! -z "$RECOVER_FROM_DUMP" ]
+			if [ "$RECOVER" -ne 0 ]
 			then
-				CONDITIONALS="${CONDITIONALS} --recover ${RECOVER_FROM_DUMP}"
+				CONDITIONALS="${CONDITIONALS} --recover"
 			fi
 			python server.py "$SERVER_CONFIG" -c "$CLIENT_CONFIG" -f "$STATIC_FILES" -p $DB_PROCESSES -a $ASYNC_DB_HELPERS_PER_PROCESS $CONDITIONALS
 		fi
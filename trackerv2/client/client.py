@@ -11,7 +11,7 @@ from queue import Empty
 from urllib.parse import urljoin
 import uvloop
 
-from utils import load_config, APIResult, Player
+from utils import load_config, APIResult, Player, RESULT_HEADER
 
 
 class TrackerClientNode(object):
@@ -220,8 +220,10 @@ async def query(key, session, workqueue, resultqueue, workdone, log):
     api_url = 'https://api-console.worldoftanks.com/wotx/account/info/'
     log.debug('Batch %i: Starting', work[0])
     start = datetime.now()
+    # Sparse batches are packed by the server into an explicit list of IDs
+    accounts = work[2] if len(work) > 2 else range(*work[1])
     params = {
-        'account_id': ','.join(map(str, range(*work[1]))),
+        'account_id': ','.join(map(str, accounts)),
         'application_id': key,
         'fields': (
             'created_at,'
@@ -301,7 +303,10 @@ async def work_handler(config, workqueue, returnqueue, workdone):
                     result = await loop.run_in_executor(None, returnqueue.get_nowait)
                 except Empty:
                     continue
-                await client.ws.send_bytes(dumps(result))
+                # The server reads the header without unpickling the result
+                await client.ws.send_bytes(
+                    RESULT_HEADER.pack(result.batch, len(result.players)) +
+                    dumps(result))
             else:
                 await asyncio.sleep(0.05)
 
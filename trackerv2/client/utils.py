@@ -1,7 +1,11 @@
 from hashlib import sha1
 from json import load, dump
+from struct import Struct
 from typing import NamedTuple
 
+# Prefix of every result message: batch ID and the number of players found
+RESULT_HEADER = Struct('<IH')
+
 
 def getsha1(filename, buffer_size=65536):
     sha1hash = sha1()
@@ -0,0 +1,47 @@
+class Backlog(object):
+    r"""
+    Results that have been received but not yet written to the database
+
+    The backlog is measured in both players and bytes. Once either crosses its
+    high watermark the backlog is considered throttled until both drop back
+    under their low watermarks.
+    """
+
+    def __init__(self, config):
+        self.high_rows = config.get('high rows', 1000000)
+        self.low_rows = config.get('low rows', self.high_rows // 2)
+        self.high_bytes = config.get('high bytes', 512 * 1024 ** 2)
+        self.low_bytes = config.get('low bytes', self.high_bytes // 2)
+        self.rows = 0
+        self.bytes = 0
+        self.pending = dict()
+        self.throttled = False
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, batch, rows, size):
+        r"""
+        :returns: True if the backlog has just become throttled
+        """
+        self.pending[batch] = (rows, size)
+        self.rows += rows
+        self.bytes += size
+        if not self.throttled and (
+                self.rows >= self.high_rows or self.bytes >= self.high_bytes):
+            self.throttled = True
+            return True
+        return False
+
+    def remove(self, batch):
+        r"""
+        :returns: True if the backlog has just been released
+        """
+        rows, size = self.pending.pop(batch, (0, 0))
+        self.rows -= rows
+        self.bytes -= size
+        if self.throttled and (
+                self.rows <= self.low_rows and self.bytes <= self.low_bytes):
+            self.throttled = False
+            return True
+        return False
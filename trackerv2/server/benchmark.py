@@ -0,0 +1,386 @@
+r"""
+Benchmarks for the server's result pipeline
+
+Run from the server directory, e.g. ``python benchmark.py queue``
+"""
+import asyncio
+from functools import partial
+from multiprocessing import Manager, Process, Queue
+from pickle import dumps
+from time import perf_counter
+
+from utils import APIResult, Player, RESULT_HEADER, load_config
+
+
+def sample_frame(batch=1, players=100):
+    r"""
+    Build a result frame comparable to what clients send for a full batch
+    """
+    result = APIResult(
+        tuple(
+            Player(
+                account_id, 'player-{}-x'.format(account_id), 1500000000,
+                1600000000, 1600000000, 12345, 'xbox', 5000, 6000, 7000000,
+                8000, 900)
+            for account_id in range(batch * 100, batch * 100 + players)),
+        1600000000.0,
+        batch)
+    return RESULT_HEADER.pack(batch, players) + dumps(result)
+
+
+def _consume(queue, count):
+    for __ in range(count):
+        queue.get()
+
+
+def queue_throughput(queue, frame, count):
+    r"""
+    Time how long it takes for one consumer process to receive `count` frames
+
+    :returns: Messages per second
+    """
+    consumer = Process(target=_consume, args=(queue, count))
+    consumer.start()
+    start = perf_counter()
+    for __ in range(count):
+        queue.put(frame)
+    consumer.join()
+    return count / (perf_counter() - start)
+
+
+def bench_queue(args):
+    frame = sample_frame()
+    manager = Manager()
+    print('Frame size: {} bytes'.format(len(frame)))
+    print('Manager().Queue:       {:10.0f} msg/s'.format(
+        queue_throughput(manager.Queue(), frame, args.count)))
+    print('multiprocessing.Queue: {:10.0f} msg/s'.format(
+        queue_throughput(Queue(args.size), frame, args.count)))
+
+
+def sample_rows(start, count, battles=12345, pulled=1600000000.0):
+    r"""
+    Build result rows as the database helpers receive them
+    """
+    return tuple(
+        (account_id, 'player-{}-x'.format(account_id), 1500000000,
+         1600000000, 1600000000, battles, 'xbox', 5000, 6000, 7000000, 8000,
+         900, pulled)
+        for account_id in range(start, start + count))
+
+
+async def ingest_throughput(db_pool, write, rows, batch):
+    r"""
+    Write `rows` in slices of `batch` players, one write per slice
+
+    :returns: Rows per second
+    """
+    start = perf_counter()
+    async with db_pool.acquire() as conn:
+        for i in range(0, len(rows), batch):
+            async with conn.transaction():
+                await write(conn, rows[i:i + batch])
+    return len(rows) / (perf_counter() - start)
+
+
+async def prepare_database(config):
+    r"""
+    Create the tables and triggers configured for the server
+    """
+    from database import setup_database
+    await setup_database(
+        config['database'],
+        trigger_mode=config.get('trigger mode', 'row'),
+        partitions=config.get('partitions'),
+        schema=config.get('schema', 'legacy'),
+        history=config.get('history'),
+        rollups=config.get('rollups'))
+
+
+def player_tables(config):
+    r"""
+    Tables to clean up after a benchmark. The `players` view of the split
+    schema cannot be deleted from.
+    """
+    if config.get('schema', 'legacy') == 'split':
+        return ('player_counters', 'player_identity')
+    return ('players',)
+
+
+async def remove_rows(conn, config, first, last):
+    r"""
+    Delete the benchmark's players, and the daily totals and differences
+    that their triggers recorded, so that they do not skew the next run.
+    Rollups of the days the benchmark wrote to are rebuilt without them.
+    """
+    from rollups import rebuild_rollups
+
+    days = [
+        record['_date'] for record in await conn.fetch(
+            'SELECT DISTINCT _date FROM diff_battles '
+            'WHERE account_id >= $1 AND account_id < $2',
+            first, last)]
+    for table in player_tables(config) + ('total_battles', 'diff_battles'):
+        await conn.execute(
+            'DELETE FROM {} WHERE account_id >= $1 AND account_id < $2'.format(
+                table),
+            first, last)
+    if config.get('rollups') is not None:
+        for day in days:
+            await rebuild_rollups(conn, day)
+
+
+async def _bench_ingest(args):
+    from asyncpg import create_pool
+    from writer import INGEST_MODES, setup_staging
+
+    config = load_config(args.config)
+    await prepare_database(config)
+    schema = config.get('schema', 'legacy')
+    db_pool = await create_pool(
+        min_size=1, max_size=1, init=setup_staging, **config['database'])
+    try:
+        for offset, mode in enumerate(INGEST_MODES):
+            write = partial(INGEST_MODES[mode], schema=schema)
+            first = args.offset + offset * args.count
+            inserts = await ingest_throughput(
+                db_pool, write, sample_rows(first, args.count), args.batch)
+            # Changed battle counts fire the daily diff triggers
+            updates = await ingest_throughput(
+                db_pool, write,
+                sample_rows(first, args.count, 12346, 1600086400.0),
+                args.batch)
+            print('{:12s} insert: {:10.0f} rows/s  update: {:10.0f} rows/s'.format(
+                mode, inserts, updates))
+    finally:
+        async with db_pool.acquire() as conn:
+            await remove_rows(
+                conn, config, args.offset,
+                args.offset + len(INGEST_MODES) * args.count)
+        await db_pool.close()
+
+
+async def _bench_triggers(args):
+    from asyncpg import connect, create_pool
+    from database import setup_triggers
+    from writer import INGEST_MODES, setup_staging
+
+    config = load_config(args.config)
+    await prepare_database(config)
+    conn = await connect(**config['database'])
+    db_pool = await create_pool(
+        min_size=1, max_size=1, init=setup_staging, **config['database'])
+    schema = config.get('schema', 'legacy')
+    write = partial(INGEST_MODES[args.mode], schema=schema)
+    modes = ('row', 'statement')
+    try:
+        for offset, mode in enumerate(modes):
+            await setup_triggers(conn, mode, schema)
+            first = args.offset + offset * args.count
+            inserts = await ingest_throughput(
+                db_pool, write, sample_rows(first, args.count), args.batch)
+            updates = await ingest_throughput(
+                db_pool, write,
+                sample_rows(first, args.count, 12346, 1600086400.0),
+                args.batch)
+            print('{:12s} insert: {:10.0f} rows/s  update: {:10.0f} rows/s'.format(
+                mode, inserts, updates))
+    finally:
+        last = args.offset + len(modes) * args.count
+        await remove_rows(conn, config, args.offset, last)
+        await setup_triggers(conn, config.get('trigger mode', 'row'), schema)
+        await conn.close()
+        await db_pool.close()
+
+
+async def read_latency(conn, query, day, count):
+    r"""
+    :returns: Average milliseconds to aggregate the totals of `day`
+    """
+    start = perf_counter()
+    for __ in range(count):
+        await conn.fetchrow(
+            'SELECT count(*), sum(battles) FROM ({}) totals'.format(query), day)
+    return (perf_counter() - start) / count * 1000
+
+
+async def _bench_history(args):
+    from asyncpg import connect, create_pool
+    from database import setup_triggers
+    from history import LATEST_TOTALS, setup_history
+    from writer import INGEST_MODES, setup_staging
+
+    config = load_config(args.config)
+    await prepare_database(config)
+    conn = await connect(**config['database'])
+    await setup_history(conn)
+    db_pool = await create_pool(
+        min_size=1, max_size=1, init=setup_staging, **config['database'])
+    schema = config.get('schema', 'legacy')
+    trigger_mode = config.get('trigger mode', 'row')
+    write = partial(INGEST_MODES[args.mode], schema=schema)
+    day = await conn.fetchval("SELECT (now() - INTERVAL '1 DAY')::date")
+    reads = {
+        'full': LATEST_TOTALS,
+        'diff': 'SELECT * FROM totals_at($1)'
+    }
+    try:
+        for offset, mode in enumerate(reads):
+            await setup_triggers(conn, trigger_mode, schema, mode)
+            first = args.offset + offset * args.count
+            inserts = await ingest_throughput(
+                db_pool, write, sample_rows(first, args.count), args.batch)
+            updates = await ingest_throughput(
+                db_pool, write,
+                sample_rows(first, args.count, 12346, 1600086400.0),
+                args.batch)
+            latency = await read_latency(conn, reads[mode], day, args.reads)
+            print('{:6s} insert: {:10.0f} rows/s  update: {:10.0f} rows/s  '
+                  'totals: {:10.1f} ms'.format(
+                      mode, inserts, updates, latency))
+    finally:
+        last = args.offset + len(reads) * args.count
+        await remove_rows(conn, config, args.offset, last)
+        await setup_triggers(
+            conn, trigger_mode, schema,
+            config.get('history', {}).get('mode', 'full'))
+        await conn.close()
+        await db_pool.close()
+
+
+def bench_history(args):
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(_bench_history(args))
+
+
+def bench_triggers(args):
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(_bench_triggers(args))
+
+
+def bench_ingest(args):
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(_bench_ingest(args))
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    agp = ArgumentParser()
+    subparsers = agp.add_subparsers(dest='benchmark')
+    subparsers.required = True
+    queue_parser = subparsers.add_parser(
+        'queue',
+        help='Compare result queue transports between processes')
+    queue_parser.add_argument(
+        '-n',
+        '--count',
+        help='Number of result frames to send',
+        type=int,
+        default=20000)
+    queue_parser.add_argument(
+        '-s',
+        '--size',
+        help='Maximum size of the bounded queue',
+        type=int,
+        default=20000)
+    queue_parser.set_defaults(func=bench_queue)
+    ingest_parser = subparsers.add_parser(
+        'ingest',
+        help=('Compare executemany and COPY ingestion. Use a scratch '
+              'database: rows are inserted and then deleted from players'))
+    ingest_parser.add_argument(
+        'config',
+        help='Server configuration file with the scratch database')
+    ingest_parser.add_argument(
+        '-n',
+        '--count',
+        help='Number of rows to write per mode',
+        type=int,
+        default=100000)
+    ingest_parser.add_argument(
+        '-b',
+        '--batch',
+        help='Rows per transaction, e.g. 100 for a single result or 5000 '
+             'for a micro-batch',
+        type=int,
+        default=100)
+    ingest_parser.add_argument(
+        '-o',
+        '--offset',
+        help='First account ID to use',
+        type=int,
+        default=2000000000)
+    ingest_parser.set_defaults(func=bench_ingest)
+    triggers_parser = subparsers.add_parser(
+        'triggers',
+        help=('Compare row and statement level triggers for daily totals. '
+              'Use a scratch database: rows are inserted and then deleted'))
+    triggers_parser.add_argument(
+        'config',
+        help='Server configuration file with the scratch database')
+    triggers_parser.add_argument(
+        '-m',
+        '--mode',
+        help='Ingest mode to write with',
+        choices=('executemany', 'copy'),
+        default='copy')
+    triggers_parser.add_argument(
+        '-n',
+        '--count',
+        help='Number of rows to write per mode',
+        type=int,
+        default=100000)
+    triggers_parser.add_argument(
+        '-b',
+        '--batch',
+        help='Rows per transaction',
+        type=int,
+        default=5000)
+    triggers_parser.add_argument(
+        '-o',
+        '--offset',
+        help='First account ID to use',
+        type=int,
+        default=2000000000)
+    triggers_parser.set_defaults(func=bench_triggers)
+    history_parser = subparsers.add_parser(
+        'history',
+        help=('Compare the write cost and the latency of rebuilding daily '
+              'totals in full and diff history modes. Use a scratch '
+              'database: rows are inserted and then deleted'))
+    history_parser.add_argument(
+        'config',
+        help='Server configuration file with the scratch database')
+    history_parser.add_argument(
+        '-m',
+        '--mode',
+        help='Ingest mode to write with',
+        choices=('executemany', 'copy'),
+        default='copy')
+    history_parser.add_argument(
+        '-n',
+        '--count',
+        help='Number of rows to write per mode',
+        type=int,
+        default=100000)
+    history_parser.add_argument(
+        '-b',
+        '--batch',
+        help='Rows per transaction',
+        type=int,
+        default=5000)
+    history_parser.add_argument(
+        '-r',
+        '--reads',
+        help='Number of times to rebuild the totals of yesterday',
+        type=int,
+        default=5)
+    history_parser.add_argument(
+        '-o',
+        '--offset',
+        help='First account ID to use',
+        type=int,
+        default=2000000000)
+    history_parser.set_defaults(func=bench_history)
+    args = agp.parse_args()
+    args.func(args)
@@ -0,0 +1,119 @@
+from ctypes import memset, sizeof
+from multiprocessing.sharedctypes import RawArray
+
+# Battle count of players that are not in the cache
+UNKNOWN = 0xFFFFFFFF
+
+
+class BattleCache(object):
+    r"""
+    Last known battle count of every player, shared by all DB helpers
+
+    Counts are stored in one shared array of 32-bit integers. Each platform
+    range occupies its own slice of the array, so a player's entry is found
+    from the offset of their ID into the range. Players outside of every range
+    are never cached.
+
+    Entries are only updated after the write containing them is committed.
+    Processes may update different entries at the same time without locking.
+
+    :param ranges: Tuple of (player start ID, player end ID) per platform
+    :param int slots: Number of processes that keep their own hit counters
+    """
+
+    def __init__(self, ranges, slots=1):
+        self._starts = []
+        self._ends = []
+        self._offsets = []
+        size = 0
+        for start, end in ranges:
+            self._starts.append(start)
+            self._ends.append(end)
+            self._offsets.append(size)
+            size += end - start
+        self.battles = RawArray('I', size)
+        memset(self.battles, 0xFF, sizeof(self.battles))
+        # Lookups and hits of each process, so that counters are never shared
+        self.counters = RawArray('Q', 2 * slots)
+
+    def __len__(self):
+        return len(self.battles)
+
+    def _index(self, account_id):
+        for start, end, offset in zip(self._starts, self._ends, self._offsets):
+            if start <= account_id < end:
+                return offset + account_id - start
+        return None
+
+    def get(self, account_id):
+        r"""
+        :returns: Battle count or None if it is not known
+        """
+        index = self._index(account_id)
+        if index is None or self.battles[index] == UNKNOWN:
+            return None
+        return self.battles[index]
+
+    def set(self, account_id, battles):
+        index = self._index(account_id)
+        if index is not None:
+            self.battles[index] = battles
+
+    def changed(self, rows, slot=0, column=5):
+        r"""
+        Remove rows whose battle count matches the cache
+
+        :param rows: Result rows, with the battle count at `column`
+        :param int slot: Counter slot of the calling process
+        :returns: Tuple of rows that need to be written
+        """
+        changed = tuple(
+            row for row in rows if self.get(row[0]) != row[column])
+        self.counters[2 * slot] += len(rows)
+        self.counters[2 * slot + 1] += len(rows) - len(changed)
+        return changed
+
+    def update(self, rows, column=5):
+        r"""
+        Record the battle counts of rows that have been committed
+        """
+        for row in rows:
+            self.set(row[0], row[column])
+
+    @property
+    def lookups(self):
+        return sum(self.counters[0::2])
+
+    @property
+    def hits(self):
+        return sum(self.counters[1::2])
+
+    def hit_rate(self):
+        r"""
+        :returns: Percentage of rows that did not need to be written
+        """
+        lookups = self.lookups
+        return (self.hits / lookups) * 100 if lookups else 0
+
+    async def load(self, conn, table='players'):
+        r"""
+        Fill the cache from the database with a bulk COPY
+
+        :returns: Number of players loaded
+        """
+        remainder = b''
+        loaded = 0
+
+        async def receive(chunk):
+            nonlocal remainder, loaded
+            lines = (remainder + chunk).split(b'\n')
+            remainder = lines.pop()
+            for line in lines:
+                account_id, battles = line.split(b'\t')
+                self.set(int(account_id), int(battles))
+            loaded += len(lines)
+
+        __ = await conn.copy_from_query(
+            'SELECT account_id, battles FROM {}'.format(table),
+            output=receive)
+        return loaded
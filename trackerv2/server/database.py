@@ -1,7 +1,11 @@
 import asyncpg
-from datetime import datetime, timedelta
+from datetime import datetime
 import json
 
+from history import migrate_history, setup_history
+from partitions import manage_partitions
+from rollups import remove_rollups, setup_rollups
+
 MASTER_COLUMNS = {
     'account_id': 'integer NOT NULL',
     'nickname': 'varchar(34) NOT NULL',
@@ -18,6 +22,24 @@ MASTER_COLUMNS = {
     '_last_api_pull': 'timestamp NOT NULL'
 }
 
+# Where the triggers find player counters and consoles in each schema mode
+SCHEMAS = {
+    'legacy': {
+        'table': 'players',
+        'row_console': '$1.console',
+        'set_console': 'n.console',
+        'set_join': ''
+    },
+    'split': {
+        'table': 'player_counters',
+        'row_console': (
+            '(SELECT console FROM player_identity '
+            'WHERE account_id = $1.account_id)'),
+        'set_console': 'i.console',
+        'set_join': ' JOIN player_identity i USING (account_id)'
+    }
+}
+
 SERIES_COLUMNS = {
     'account_id': 'integer NOT NULL',
     'battles': 'integer',
@@ -38,9 +60,7 @@ async def add_missing_columns(conn, table, schema):
             __ = await conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
 
 
-async def setup_database(db, use_temp=False):
-    now = datetime.now()
-    conn = await asyncpg.connect(**db)
+async def setup_players(conn):
     __ = await conn.execute('''
         CREATE TABLE IF NOT EXISTS players (
             account_id integer PRIMARY KEY,
@@ -59,6 +79,76 @@ async def setup_database(db, use_temp=False):
 
     __ = await add_missing_columns(conn, 'players', MASTER_COLUMNS)
 
+
+async def setup_split_schema(conn):
+    r"""
+    Store players in two tables: `player_identity`, which rarely changes, and
+    `player_counters`, which is rewritten whenever a player has played. The
+    `players` view joins them back together for readers.
+
+    An existing `players` table is copied into the new tables and renamed to
+    `players_legacy`. There is no migration back to a single table.
+    """
+    __ = await conn.execute('''
+        CREATE TABLE IF NOT EXISTS player_identity (
+            account_id integer PRIMARY KEY,
+            nickname varchar(34) NOT NULL,
+            console varchar(4) NOT NULL,
+            created_at timestamp NOT NULL)''')
+
+    __ = await conn.execute('''
+        CREATE TABLE IF NOT EXISTS player_counters (
+            account_id integer PRIMARY KEY,
+            last_battle_time timestamp NOT NULL,
+            updated_at timestamp NOT NULL,
+            battles integer NOT NULL,
+            spotted integer,
+            wins integer,
+            damage_dealt integer,
+            frags integer,
+            dropped_capture_points integer,
+            _last_api_pull timestamp NOT NULL)''')
+
+    legacy = await conn.fetchval(
+        "SELECT relkind = 'r' FROM pg_class WHERE oid = to_regclass('players')")
+    if legacy:
+        # Counter triggers are not installed yet, so history is not touched
+        async with conn.transaction():
+            __ = await conn.execute('''
+                INSERT INTO player_identity (
+                  account_id, nickname, console, created_at)
+                SELECT account_id, nickname, console, created_at FROM players
+                ON CONFLICT DO NOTHING''')
+            __ = await conn.execute('''
+                INSERT INTO player_counters (
+                  account_id, last_battle_time, updated_at, battles, spotted,
+                  wins, damage_dealt, frags, dropped_capture_points,
+                  _last_api_pull)
+                SELECT account_id, last_battle_time, updated_at, battles,
+                  spotted, wins, damage_dealt, frags, dropped_capture_points,
+                  _last_api_pull
+                FROM players
+                ON CONFLICT DO NOTHING''')
+            __ = await conn.execute(
+                'ALTER TABLE players RENAME TO players_legacy')
+
+    # Same columns, in the same order, as the `players` table
+    __ = await conn.execute('''
+        CREATE OR REPLACE VIEW players AS
+        SELECT c.account_id, i.nickname, i.console, i.created_at,
+          c.last_battle_time, c.updated_at, c.battles, c.spotted, c.wins,
+          c.damage_dealt, c.frags, c.dropped_capture_points, c._last_api_pull
+        FROM player_counters c JOIN player_identity i USING (account_id)''')
+
+
+async def setup_database(db, use_temp=False, trigger_mode='row', partitions=None, schema='legacy', history=None, rollups=None):
+    now = datetime.now()
+    conn = await asyncpg.connect(**db)
+    if schema == 'split':
+        __ = await setup_split_schema(conn)
+    else:
+        __ = await setup_players(conn)
+
     if use_temp:
         __ = await conn.execute('DROP TABLE IF EXISTS temp_players')
 
@@ -120,30 +210,53 @@ async def setup_database(db, use_temp=False):
 
     __ = await add_missing_columns(conn, 'diff_battles', SERIES_COLUMNS)
 
-    # Cannot set new columns to NOT NULL until data is retroactively added
-    __ = await conn.execute('''
-        CREATE TABLE {}
-        PARTITION OF total_battles
-        FOR VALUES FROM ('{}') TO ('{}')
-        '''.format(
-            (now - timedelta(days=1)).strftime('total_battles_%Y_%m_%d'),
-            (now - timedelta(days=1)).strftime('%Y-%m-%d'),
-            now.strftime('%Y-%m-%d')
-        )
-    )
+    created, archived = await manage_partitions(conn, partitions, now.date())
 
-    # Cannot set new columns to NOT NULL until data is retroactively added
-    __ = await conn.execute('''
-        CREATE TABLE {}
-        PARTITION OF diff_battles
-        FOR VALUES FROM ('{}') TO ('{}')
-        '''.format(
-            (now - timedelta(days=1)).strftime('diff_battles_%Y_%m_%d'),
-            (now - timedelta(days=1)).strftime('%Y-%m-%d'),
-            now.strftime('%Y-%m-%d')
-        )
-    )
+    history_mode = (history or {}).get('mode', 'full')
+    if history_mode == 'diff':
+        __ = await setup_history(conn)
+        # Before the triggers stop writing daily totals
+        __ = await migrate_history(conn)
+
+    __ = await setup_triggers(conn, trigger_mode, schema, history_mode)
+    if rollups is not None:
+        __ = await setup_rollups(conn, rollups.get('shards', 8))
+    else:
+        __ = await remove_rollups(conn)
+    return created, archived
+
+
+def trigger_options(schema='legacy', history='full'):
+    r"""
+    :returns: Values substituted into the trigger functions
+    """
+    # Totals are rebuilt from checkpoints and differences in 'diff' mode
+    return dict(SCHEMAS[schema], totals='true' if history == 'full' else 'false')
 
+
+async def setup_triggers(conn, mode='row', schema='legacy', history='full'):
+    r"""
+    Install the triggers that record daily totals and differences
+
+    In 'row' mode every changed player runs its own dynamic INSERT statements.
+    In 'statement' mode the rows changed by a whole statement are read from
+    transition tables and recorded with one INSERT per table. The triggers of
+    the other mode are removed.
+
+    In 'split' schema mode the triggers are placed on `player_counters` and
+    look up each player's console in `player_identity`.
+
+    In 'diff' history mode only differences are recorded. See `history`.
+    """
+    table = SCHEMAS[schema]['table']
+    options = trigger_options(schema, history)
+    if mode == 'statement':
+        __ = await conn.execute('DROP TRIGGER IF EXISTS update_stats ON {}'.format(table))
+        __ = await conn.execute('DROP TRIGGER IF EXISTS new_player_total ON {}'.format(table))
+        __ = await setup_statement_triggers(conn, schema, history)
+        return
+    __ = await conn.execute('DROP TRIGGER IF EXISTS update_stats_set ON {}'.format(table))
+    __ = await conn.execute('DROP TRIGGER IF EXISTS new_player_total_set ON {}'.format(table))
     # We shouldn't get a duplicate error because of the REPLACE statement
     try:
         __ = await conn.execute('''
@@ -152,18 +265,20 @@ async def setup_database(db, use_temp=False):
             $func$
             BEGIN
               IF (OLD.battles < NEW.battles) THEN
-                EXECUTE 'INSERT INTO total_battles ('
-                  'account_id, battles, console, spotted, wins, damage_dealt, '
-                  'frags, dropped_capture_points, _date'
-                  ') VALUES ('
-                  '$1.account_id, $1.battles, $1.console, $1.spotted, $1.wins, '
-                  '$1.damage_dealt, $1.frags, $1.dropped_capture_points, (now() - INTERVAL ''1 DAY'')::date) '
-                  'ON CONFLICT DO NOTHING' USING NEW;
+                IF ({totals}) THEN
+                  EXECUTE 'INSERT INTO total_battles ('
+                    'account_id, battles, console, spotted, wins, damage_dealt, '
+                    'frags, dropped_capture_points, _date'
+                    ') VALUES ('
+                    '$1.account_id, $1.battles, {row_console}, $1.spotted, $1.wins, '
+                    '$1.damage_dealt, $1.frags, $1.dropped_capture_points, (now() - INTERVAL ''1 DAY'')::date) '
+                    'ON CONFLICT DO NOTHING' USING NEW;
+                END IF;
                 EXECUTE 'INSERT INTO diff_battles ('
                   'account_id, battles, console, spotted, wins, damage_dealt, '
                   'frags, dropped_capture_points, _date'
                   ') VALUES ('
-                  '$1.account_id, $1.battles - $2.battles, $1.console, '
+                  '$1.account_id, $1.battles - $2.battles, {row_console}, '
                   '$1.spotted - $2.spotted, $1.wins - $2.wins, '
                   '$1.damage_dealt - $2.damage_dealt, $1.frags - $2.frags, '
                   '$1.dropped_capture_points - $2.dropped_capture_points, (now() - INTERVAL ''1 DAY'')::date) '
@@ -171,12 +286,12 @@ async def setup_database(db, use_temp=False):
               END IF;
               RETURN NEW;
             END
-            $func$ LANGUAGE plpgsql;''')
+            $func$ LANGUAGE plpgsql;'''.format(**options))
     except asyncpg.exceptions.DuplicateObjectError:
         pass
 
     try:
-        __ = await conn.execute('CREATE TRIGGER update_stats BEFORE UPDATE ON players FOR EACH ROW EXECUTE PROCEDURE update_total();')
+        __ = await conn.execute('CREATE TRIGGER update_stats BEFORE UPDATE ON {} FOR EACH ROW EXECUTE PROCEDURE update_total();'.format(table))
     except asyncpg.exceptions.DuplicateObjectError:
         pass
 
@@ -188,34 +303,161 @@ async def setup_database(db, use_temp=False):
               RETURNS trigger AS
             $func$
             BEGIN
-              EXECUTE 'INSERT INTO total_battles ('
-                'account_id, battles, console, spotted, wins, damage_dealt, '
-                'frags, dropped_capture_points, _date'
-                ') VALUES ('
-                '$1.account_id, $1.battles, $1.console, $1.spotted, $1.wins, '
-                '$1.damage_dealt, $1.frags, $1.dropped_capture_points, (now() - INTERVAL ''1 DAY'')::date) '
-                'ON CONFLICT DO NOTHING' USING NEW;
+              IF ({totals}) THEN
+                EXECUTE 'INSERT INTO total_battles ('
+                  'account_id, battles, console, spotted, wins, damage_dealt, '
+                  'frags, dropped_capture_points, _date'
+                  ') VALUES ('
+                  '$1.account_id, $1.battles, {row_console}, $1.spotted, $1.wins, '
+                  '$1.damage_dealt, $1.frags, $1.dropped_capture_points, (now() - INTERVAL ''1 DAY'')::date) '
+                  'ON CONFLICT DO NOTHING' USING NEW;
+              END IF;
               IF (NEW.battles > 0) THEN
                 EXECUTE 'INSERT INTO diff_battles ('
                   'account_id, battles, console, spotted, wins, damage_dealt, '
                   'frags, dropped_capture_points, _date'
                   ') VALUES ('
-                  '$1.account_id, $1.battles, $1.console, $1.spotted, $1.wins, '
+                  '$1.account_id, $1.battles, {row_console}, $1.spotted, $1.wins, '
                   '$1.damage_dealt, $1.frags, $1.dropped_capture_points, (now() - INTERVAL ''1 DAY'')::date) '
                   'ON CONFLICT DO NOTHING' USING NEW;
               END IF;
               RETURN NEW;
             END
-            $func$ LANGUAGE plpgsql;''')
+            $func$ LANGUAGE plpgsql;'''.format(**options))
+    except asyncpg.exceptions.DuplicateObjectError:
+        pass
+
+    try:
+        __ = await conn.execute('CREATE TRIGGER new_player_total AFTER INSERT ON {} FOR EACH ROW EXECUTE PROCEDURE new_player();'.format(table))
+    except asyncpg.exceptions.DuplicateObjectError:
+        pass
+
+
+async def setup_statement_triggers(conn, schema='legacy', history='full'):
+    options = trigger_options(schema, history)
+    __ = await conn.execute('''
+        CREATE OR REPLACE FUNCTION update_totals()
+          RETURNS trigger AS
+        $func$
+        BEGIN
+          INSERT INTO total_battles (
+            account_id, battles, console, spotted, wins, damage_dealt,
+            frags, dropped_capture_points, _date)
+          SELECT n.account_id, n.battles, {set_console}, n.spotted, n.wins,
+            n.damage_dealt, n.frags, n.dropped_capture_points,
+            (now() - INTERVAL '1 DAY')::date
+          FROM new_players n JOIN old_players o USING (account_id){set_join}
+          WHERE {totals} AND o.battles < n.battles
+          ON CONFLICT DO NOTHING;
+          INSERT INTO diff_battles (
+            account_id, battles, console, spotted, wins, damage_dealt,
+            frags, dropped_capture_points, _date)
+          SELECT n.account_id, n.battles - o.battles, {set_console},
+            n.spotted - o.spotted, n.wins - o.wins,
+            n.damage_dealt - o.damage_dealt, n.frags - o.frags,
+            n.dropped_capture_points - o.dropped_capture_points,
+            (now() - INTERVAL '1 DAY')::date
+          FROM new_players n JOIN old_players o USING (account_id){set_join}
+          WHERE o.battles < n.battles
+          ON CONFLICT DO NOTHING;
+          RETURN NULL;
+        END
+        $func$ LANGUAGE plpgsql;'''.format(**options))
+
+    # New players have a previous total of 0, so their whole count is also
+    # that day's difference
+    __ = await conn.execute('''
+        CREATE OR REPLACE FUNCTION new_players_total()
+          RETURNS trigger AS
+        $func$
+        BEGIN
+          INSERT INTO total_battles (
+            account_id, battles, console, spotted, wins, damage_dealt,
+            frags, dropped_capture_points, _date)
+          SELECT n.account_id, n.battles, {set_console}, n.spotted, n.wins,
+            n.damage_dealt, n.frags, n.dropped_capture_points,
+            (now() - INTERVAL '1 DAY')::date
+          FROM new_players n{set_join}
+          WHERE {totals}
+          ON CONFLICT DO NOTHING;
+          INSERT INTO diff_battles (
+            account_id, battles, console, spotted, wins, damage_dealt,
+            frags, dropped_capture_points, _date)
+          SELECT n.account_id, n.battles, {set_console}, n.spotted, n.wins,
+            n.damage_dealt, n.frags, n.dropped_capture_points,
+            (now() - INTERVAL '1 DAY')::date
+          FROM new_players n{set_join}
+          WHERE n.battles > 0
+          ON CONFLICT DO NOTHING;
+          RETURN NULL;
+        END
+        $func$ LANGUAGE plpgsql;'''.format(**options))
+
+    # Only AFTER triggers can reference transition tables. An upsert fires
+    # both of these: inserted players in one and updated players in the other
+    try:
+        __ = await conn.execute('CREATE TRIGGER update_stats_set AFTER UPDATE ON {} REFERENCING OLD TABLE AS old_players NEW TABLE AS new_players FOR EACH STATEMENT EXECUTE PROCEDURE update_totals();'.format(SCHEMAS[schema]['table']))
     except asyncpg.exceptions.DuplicateObjectError:
         pass
 
     try:
-        __ = await conn.execute('CREATE TRIGGER new_player_total AFTER INSERT ON players FOR EACH ROW EXECUTE PROCEDURE new_player();')
+        __ = await conn.execute('CREATE TRIGGER new_player_total_set AFTER INSERT ON {} REFERENCING NEW TABLE AS new_players FOR EACH STATEMENT EXECUTE PROCEDURE new_players_total();'.format(SCHEMAS[schema]['table']))
     except asyncpg.exceptions.DuplicateObjectError:
         pass
 
 
+async def fetch_window_stats(db, ranges, batch_size=100):
+    r"""
+    Count the known players and find the most recent battle of every batch
+    window that has returned players in previous runs
+
+    :returns: One dictionary per range, mapping the index of each batch window
+        within the range to a tuple of (player count, most recent battle time)
+    """
+    conn = await asyncpg.connect(**db)
+    stats = []
+    for start, end in ranges:
+        records = await conn.fetch(
+            'SELECT (account_id - $1) / $3 AS window, COUNT(*) AS accounts, '
+            'MAX(last_battle_time) AS last_battle '
+            'FROM players WHERE account_id >= $1 AND account_id < $2 '
+            'GROUP BY 1',
+            start,
+            end,
+            batch_size
+        )
+        stats.append({
+            record['window']: (record['accounts'], record['last_battle'])
+            for record in records})
+    await conn.close()
+    return stats
+
+
+async def fetch_account_ids(db, ranges, windows, batch_size=100):
+    r"""
+    Fetch the known player IDs of selected batch windows
+
+    :param list windows: One list of window indexes per range
+    :returns: One sorted list of player IDs per range
+    """
+    conn = await asyncpg.connect(**db)
+    accounts = []
+    for (start, end), selected in zip(ranges, windows):
+        records = await conn.fetch(
+            'SELECT account_id FROM players '
+            'WHERE account_id >= $1 AND account_id < $2 '
+            'AND (account_id - $1) / $3 = ANY($4::int[]) '
+            'ORDER BY account_id',
+            start,
+            end,
+            batch_size,
+            selected
+        )
+        accounts.append([record['account_id'] for record in records])
+    await conn.close()
+    return accounts
+
+
 async def expand_max_players(config, filename='./config/server.json'):
     dbconf = config['database']
     update = False
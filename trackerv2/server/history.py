@@ -0,0 +1,145 @@
+r"""
+Diff-only history of player totals
+
+In 'full' history mode, every player that played writes a row to
+`total_battles` and to `diff_battles` each day. In 'diff' mode, the triggers
+only write `diff_battles`. A full snapshot of `players` is written to
+`total_battles` as a checkpoint every `checkpoint days` days. The totals of
+any day are then rebuilt by `totals_at(day)`: each player's latest checkpoint
+on or before that day, plus the differences recorded since.
+
+Checkpoints are listed in `history_checkpoints`. Switching an existing
+database to 'diff' mode writes a first checkpoint from the latest
+`total_battles` row of each player. Partitions from before that checkpoint are
+only needed to rebuild older days and can be archived as usual.
+"""
+from datetime import timedelta
+
+TOTALS_AT = '''
+    CREATE OR REPLACE FUNCTION totals_at(day date)
+      RETURNS TABLE (
+        account_id integer,
+        battles integer,
+        console varchar(4),
+        spotted integer,
+        wins integer,
+        damage_dealt integer,
+        frags integer,
+        dropped_capture_points integer) AS
+    $func$
+      WITH checkpoint AS (
+        SELECT DISTINCT ON (t.account_id) t.*
+        FROM total_battles t
+        WHERE t._date <= day
+        ORDER BY t.account_id, t._date DESC
+      ), changes AS (
+        SELECT d.account_id, max(d.console) AS console,
+          sum(d.battles) AS battles, sum(d.spotted) AS spotted,
+          sum(d.wins) AS wins, sum(d.damage_dealt) AS damage_dealt,
+          sum(d.frags) AS frags,
+          sum(d.dropped_capture_points) AS dropped_capture_points
+        FROM diff_battles d
+          LEFT JOIN checkpoint c USING (account_id)
+        WHERE d._date <= day AND (c._date IS NULL OR d._date > c._date)
+        GROUP BY d.account_id
+      )
+      SELECT account_id,
+        (coalesce(c.battles, 0) + coalesce(d.battles, 0))::integer,
+        coalesce(c.console, d.console),
+        (coalesce(c.spotted, 0) + coalesce(d.spotted, 0))::integer,
+        (coalesce(c.wins, 0) + coalesce(d.wins, 0))::integer,
+        (coalesce(c.damage_dealt, 0) + coalesce(d.damage_dealt, 0))::integer,
+        (coalesce(c.frags, 0) + coalesce(d.frags, 0))::integer,
+        (coalesce(c.dropped_capture_points, 0) +
+          coalesce(d.dropped_capture_points, 0))::integer
+      FROM checkpoint c FULL JOIN changes d USING (account_id)
+    $func$ LANGUAGE sql STABLE;'''
+
+# Full-mode equivalent of `totals_at`, for comparison
+LATEST_TOTALS = '''
+    SELECT DISTINCT ON (account_id) *
+    FROM total_battles
+    WHERE _date <= $1
+    ORDER BY account_id, _date DESC'''
+
+
+async def setup_history(conn):
+    __ = await conn.execute('''
+        CREATE TABLE IF NOT EXISTS history_checkpoints (
+            _date date PRIMARY KEY,
+            written integer NOT NULL,
+            created timestamp NOT NULL DEFAULT now())''')
+    __ = await conn.execute(TOTALS_AT)
+
+
+async def last_checkpoint(conn):
+    r"""
+    :returns: Date of the newest checkpoint or None
+    """
+    return await conn.fetchval('SELECT max(_date) FROM history_checkpoints')
+
+
+def checkpoint_due(last, day, every=7):
+    return last is None or day - last >= timedelta(days=every)
+
+
+async def record_checkpoint(conn, day, status):
+    # Status of an INSERT is 'INSERT 0 <rows>'
+    written = int(status.split()[-1])
+    __ = await conn.execute(
+        'INSERT INTO history_checkpoints (_date, written) VALUES ($1, $2) '
+        'ON CONFLICT (_date) DO UPDATE SET written = EXCLUDED.written',
+        day, written)
+    return written
+
+
+async def migrate_history(conn):
+    r"""
+    Write the first checkpoint from the latest `total_battles` row of each
+    player, dated the newest day in `total_battles`. Does nothing once a
+    checkpoint exists or if there is no history yet.
+
+    :returns: Tuple of (checkpoint day, rows written) or None
+    """
+    if await last_checkpoint(conn) is not None:
+        return None
+    day = await conn.fetchval('SELECT max(_date) FROM total_battles')
+    if day is None:
+        return None
+    async with conn.transaction():
+        # Players that played on `day` already have their row
+        status = await conn.execute('''
+            INSERT INTO total_battles (
+              account_id, battles, console, spotted, wins, damage_dealt,
+              frags, dropped_capture_points, _date)
+            SELECT account_id, battles, console, spotted, wins, damage_dealt,
+              frags, dropped_capture_points, $1::date
+            FROM ({}) latest
+            ON CONFLICT DO NOTHING'''.format(LATEST_TOTALS), day)
+        written = await record_checkpoint(conn, day, status)
+    return day, written
+
+
+async def write_checkpoint(conn, every=7, day=None):
+    r"""
+    Snapshot `players` into `total_battles` if the last checkpoint is at least
+    `every` days older than `day`. Called after a run, once `players` holds
+    the totals of `day`.
+
+    :param day: Defaults to the day the triggers are recording
+    :returns: Number of players in the checkpoint or None if none was due
+    """
+    if day is None:
+        day = await conn.fetchval("SELECT (now() - INTERVAL '1 DAY')::date")
+    if not checkpoint_due(await last_checkpoint(conn), day, every):
+        return None
+    async with conn.transaction():
+        status = await conn.execute('''
+            INSERT INTO total_battles (
+              account_id, battles, console, spotted, wins, damage_dealt,
+              frags, dropped_capture_points, _date)
+            SELECT account_id, battles, console, spotted, wins, damage_dealt,
+              frags, dropped_capture_points, $1::date
+            FROM players
+            ON CONFLICT DO NOTHING''', day)
+        return await record_checkpoint(conn, day, status)
@@ -0,0 +1,58 @@
+from array import array
+from os import fsync, mkdir
+from os.path import exists
+from os.path import split as psplit
+
+
+class CompletionJournal(object):
+    r"""
+    Append-only record of batches that have been written to the database
+
+    Batch IDs are stored as unsigned 32-bit integers. Appends are buffered and
+    only flushed to disk when `sync` is called, allowing several completions
+    to share a single `fsync`.
+    """
+
+    def __init__(self, filename, resume=False):
+        parent_dir = psplit(filename)[0]
+        if parent_dir and not exists(parent_dir):
+            mkdir(parent_dir)
+        self.filename = filename
+        self._file = open(filename, 'ab' if resume else 'wb')
+        # Drop a torn entry so that new appends stay aligned
+        self._file.truncate(
+            self._file.tell() - self._file.tell() % array('I').itemsize)
+        self._file.seek(0, 2)
+        self._dirty = False
+
+    def append(self, batches):
+        self._file.write(array('I', batches).tobytes())
+        self._dirty = True
+
+    def sync(self):
+        if not self._dirty:
+            return
+        self._file.flush()
+        fsync(self._file.fileno())
+        self._dirty = False
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+    @staticmethod
+    def replay(filename):
+        r"""
+        Read every batch ID recorded in a journal
+
+        :returns: array of batch IDs
+        """
+        batches = array('I')
+        if not exists(filename):
+            return batches
+        with open(filename, 'rb') as f:
+            data = f.read()
+        # Ignore a partially written entry at the end of the file
+        data = data[:len(data) - (len(data) % batches.itemsize)]
+        batches.frombytes(data)
+        return batches
@@ -0,0 +1,151 @@
+import asyncio
+import logging
+
+MERGE_TEMP_PLAYERS = '''
+    INSERT INTO players (
+      account_id, nickname, console, created_at,
+      last_battle_time, updated_at, battles, spotted, wins,
+      damage_dealt, frags, dropped_capture_points, _last_api_pull)
+    SELECT * FROM temp_players WHERE account_id >= $1 AND account_id < $2
+    ON CONFLICT (account_id)
+    DO UPDATE SET (
+      nickname, last_battle_time, updated_at, battles,
+      console, spotted, wins, damage_dealt, frags,
+      dropped_capture_points, _last_api_pull
+    ) = (
+      EXCLUDED.nickname, EXCLUDED.last_battle_time,
+      EXCLUDED.updated_at, EXCLUDED.battles, EXCLUDED.console,
+      EXCLUDED.spotted, EXCLUDED.wins, EXCLUDED.damage_dealt,
+      EXCLUDED.frags, EXCLUDED.dropped_capture_points,
+      EXCLUDED._last_api_pull)
+    WHERE players.battles <> EXCLUDED.battles'''
+
+# Split schema: identity only for new players and changed nicknames
+MERGE_TEMP_IDENTITY = '''
+    INSERT INTO player_identity (account_id, nickname, console, created_at)
+    SELECT t.account_id, t.nickname, t.console, t.created_at
+    FROM temp_players t
+      LEFT JOIN player_identity i USING (account_id)
+    WHERE t.account_id >= $1 AND t.account_id < $2
+      AND i.nickname IS DISTINCT FROM t.nickname
+    ON CONFLICT (account_id)
+    DO UPDATE SET nickname = EXCLUDED.nickname
+    WHERE player_identity.nickname <> EXCLUDED.nickname'''
+
+MERGE_TEMP_COUNTERS = '''
+    INSERT INTO player_counters (
+      account_id, last_battle_time, updated_at, battles, spotted, wins,
+      damage_dealt, frags, dropped_capture_points, _last_api_pull)
+    SELECT
+      account_id, last_battle_time, updated_at, battles, spotted, wins,
+      damage_dealt, frags, dropped_capture_points, _last_api_pull
+    FROM temp_players WHERE account_id >= $1 AND account_id < $2
+    ON CONFLICT (account_id)
+    DO UPDATE SET (
+      last_battle_time, updated_at, battles, spotted, wins,
+      damage_dealt, frags, dropped_capture_points, _last_api_pull
+    ) = (
+      EXCLUDED.last_battle_time, EXCLUDED.updated_at, EXCLUDED.battles,
+      EXCLUDED.spotted, EXCLUDED.wins, EXCLUDED.damage_dealt,
+      EXCLUDED.frags, EXCLUDED.dropped_capture_points,
+      EXCLUDED._last_api_pull)
+    WHERE player_counters.battles <> EXCLUDED.battles'''
+
+MERGE_STATEMENTS = {
+    'legacy': (MERGE_TEMP_PLAYERS,),
+    # Identity first, so that counter triggers can find the console
+    'split': (MERGE_TEMP_IDENTITY, MERGE_TEMP_COUNTERS)
+}
+
+
+class TempMerger(object):
+    r"""
+    Merge `temp_players` into `players` while the run is still going
+
+    Batches are grouped into chunks of consecutive batches. A chunk is merged
+    with a single statement as soon as every batch in it has been written or
+    skipped. Chunks are merged in parallel, up to one per connection in the
+    pool, so that only the last chunks are left for the end of the run.
+
+    :param planner: `WorkPlanner` of the run
+    :param db_pool: asyncpg connection pool used for merging
+    :param int size: Number of batches per chunk
+    :param int connections: Number of connections in `db_pool`
+    :param str schema: 'legacy' or 'split' layout of the primary table
+    """
+
+    def __init__(self, planner, db_pool, size=1000, connections=4, schema='legacy'):
+        self.planner = planner
+        self.statements = MERGE_STATEMENTS[schema]
+        self.db_pool = db_pool
+        self.size = size
+        self.connections = connections
+        self.logger = logging.getLogger('WoTServer')
+        # Chunks by their first batch
+        self.merged = set()
+        self.running = dict()
+
+    def __len__(self):
+        return len(self.merged)
+
+    @property
+    def unmerged(self):
+        return sum(1 for __ in self._unmerged())
+
+    def _unmerged(self):
+        for chunk in self.planner.chunks(self.size):
+            if chunk[0] not in self.merged and chunk[0] not in self.running:
+                yield chunk
+
+    async def merge(self, chunk):
+        first, end, (start, stop) = chunk
+        try:
+            async with self.db_pool.acquire() as conn:
+                async with conn.transaction():
+                    for statement in self.statements:
+                        __ = await conn.execute(statement, start, stop)
+            self.merged.add(first)
+            self.logger.debug(
+                'Merged batches %i to %i into primary table', first, end - 1)
+        except Exception as e:
+            # Left unmerged so that it is attempted again
+            self.logger.error(
+                'Failed to merge batches %i to %i: %s', first, end - 1, e)
+        finally:
+            del self.running[first]
+
+    def _start(self, chunk):
+        self.running[chunk[0]] = asyncio.ensure_future(self.merge(chunk))
+
+    def start(self):
+        r"""
+        Begin merging chunks that are fully written, without waiting for them
+        to finish
+
+        :returns: Number of chunks started
+        """
+        idle = self.connections - len(self.running)
+        started = 0
+        for chunk in self._unmerged():
+            if started >= idle:
+                break
+            if self.planner.settled(chunk[0], chunk[1]):
+                self._start(chunk)
+                started += 1
+        return started
+
+    async def finish(self):
+        r"""
+        Merge every chunk that is left, regardless of the state of its
+        batches. Called once all results have been written.
+
+        :returns: Number of chunks attempted at the end of the run
+        """
+        if self.running:
+            __ = await asyncio.gather(*self.running.values())
+        remaining = list(self._unmerged())
+        for chunk in remaining:
+            self._start(chunk)
+        # The pool limits how many of these run at once
+        __ = await asyncio.gather(*self.running.values())
+        return len(remaining)
@@ -0,0 +1,154 @@
+r"""
+Daily partitions of the time series tables
+
+Partitions are named ``<table>_YYYY_MM_DD`` and hold a single day. They are
+created ahead of time and back-filled for days that were missed, so no run
+depends on a previous one having created its partition. Partitions that fall
+out of the retention window are detached and moved to an archive schema,
+where they can be dumped or dropped without touching the live tables.
+"""
+from datetime import date, datetime, timedelta
+
+# Tables partitioned by `_date`
+SERIES_TABLES = ('total_battles', 'diff_battles')
+
+
+def partition_name(table, day):
+    return '{}_{}'.format(table, day.strftime('%Y_%m_%d'))
+
+
+def partition_day(table, name):
+    r"""
+    :returns: Day held by a partition or None if it is not named by
+        `partition_name`
+    """
+    if not name.startswith(table + '_'):
+        return None
+    try:
+        return datetime.strptime(name[len(table) + 1:], '%Y_%m_%d').date()
+    except ValueError:
+        return None
+
+
+async def existing_partitions(conn, table):
+    r"""
+    :returns: Dictionary of day to partition name for a table
+    """
+    records = await conn.fetch('''
+        SELECT child.relname
+        FROM pg_inherits
+          JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+          JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = $1''', table)
+    partitions = {}
+    for record in records:
+        day = partition_day(table, record['relname'])
+        if day is not None:
+            partitions[day] = record['relname']
+    return partitions
+
+
+async def index_partition(conn, name, index='brin'):
+    r"""
+    Give a partition its own index on `account_id`. BRIN indexes stay tiny
+    because players are written in roughly ascending order.
+    """
+    if index in ('brin', 'btree'):
+        __ = await conn.execute(
+            'CREATE INDEX IF NOT EXISTS {0}_account_id_{1} '
+            'ON {0} USING {1} (account_id)'.format(name, index))
+
+
+async def create_partition(conn, table, day, index='brin'):
+    r"""
+    Create the partition for a day if it does not exist yet
+    """
+    name = partition_name(table, day)
+    __ = await conn.execute('''
+        CREATE TABLE IF NOT EXISTS {}
+        PARTITION OF {}
+        FOR VALUES FROM ('{}') TO ('{}')'''.format(
+            name,
+            table,
+            day.isoformat(),
+            (day + timedelta(days=1)).isoformat()))
+    __ = await index_partition(conn, name, index)
+    return name
+
+
+async def archive_name(conn, name, schema='archive'):
+    r"""
+    :returns: `name`, or `name` with a numbered suffix if a table of that name
+        has already been archived
+    """
+    candidate = name
+    suffix = 0
+    while await conn.fetchval(
+            'SELECT to_regclass($1)', '{}.{}'.format(schema, candidate)):
+        suffix += 1
+        candidate = '{}_{}'.format(name, suffix)
+    return candidate
+
+
+async def archive_partition(conn, table, name, schema='archive'):
+    r"""
+    :returns: Name of the partition in the archive schema
+    """
+    __ = await conn.execute('CREATE SCHEMA IF NOT EXISTS {}'.format(schema))
+    archived = await archive_name(conn, name, schema)
+    async with conn.transaction():
+        __ = await conn.execute(
+            'ALTER TABLE {} DETACH PARTITION {}'.format(table, name))
+        if archived != name:
+            __ = await conn.execute(
+                'ALTER TABLE {} RENAME TO {}'.format(name, archived))
+        __ = await conn.execute(
+            'ALTER TABLE {} SET SCHEMA {}'.format(archived, schema))
+    return archived
+
+
+async def manage_partitions(conn, config=None, today=None):
+    r"""
+    Prepare the partitions of every time series table
+
+    Partitions are created from the day after the newest existing partition,
+    or yesterday if there are none, through `ahead days` days after today.
+    At most `backfill days` days before today are back-filled, so a long
+    downtime does not create a partition for every missed day. Partitions
+    that ended more than `retention days` ago are archived.
+
+    :param dict config: 'partitions' server configuration
+    :returns: Tuple of (partitions created, partitions archived)
+    """
+    config = config or {}
+    today = today or date.today()
+    ahead = config.get('ahead days', 7)
+    backfill = config.get('backfill days', 7)
+    retention = config.get('retention days')
+    index = config.get('index', 'brin')
+    schema = config.get('archive schema', 'archive')
+    oldest = today - timedelta(days=retention) if retention else None
+    created = []
+    archived = []
+    for table in SERIES_TABLES:
+        partitions = await existing_partitions(conn, table)
+        # Data is always recorded for the day before the run
+        first = today - timedelta(days=1)
+        if partitions:
+            first = min(first, max(partitions) + timedelta(days=1))
+        first = max(first, today - timedelta(days=max(backfill, 1)))
+        if oldest is not None:
+            first = max(first, oldest)
+        day = first
+        while day <= today + timedelta(days=ahead):
+            if day not in partitions:
+                created.append(await create_partition(conn, table, day, index))
+            day += timedelta(days=1)
+        for day, name in sorted(partitions.items()):
+            if oldest is not None and day + timedelta(days=1) <= oldest:
+                archived.append(
+                    await archive_partition(conn, table, name, schema))
+            else:
+                # Partitions from before the index was configured
+                __ = await index_partition(conn, name, index)
+    return created, archived
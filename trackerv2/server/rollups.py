@@ -0,0 +1,160 @@
+r"""
+Daily rollups of `diff_battles`
+
+Every INSERT into `diff_battles` adds its rows to per-day, per-console sums in
+`daily_rollup` and to a histogram of battles per player in `daily_histogram`.
+The rollups are maintained by a statement level trigger, so a micro-batch
+written with 'statement' trigger mode updates them with one statement per
+table. In 'row' trigger mode they are updated once per player.
+
+Each backend adds to its own shard of a day's rows (`pg_backend_pid() %
+shards`), so DB helpers committing at the same time do not wait on each
+other's row locks. Readers sum the shards.
+
+Histogram bucket `b` counts players with `2 ** b` to `2 ** (b + 1) - 1`
+battles on that day.
+"""
+
+ROLLUP_DIFFS = '''
+    CREATE OR REPLACE FUNCTION rollup_diffs()
+      RETURNS trigger AS
+    $func$
+    BEGIN
+      INSERT INTO daily_rollup AS r (
+        _date, console, shard, players, battles, wins, damage_dealt, frags)
+      SELECT _date, console, pg_backend_pid() % {shards}, count(*),
+        sum(battles), coalesce(sum(wins), 0),
+        coalesce(sum(damage_dealt), 0), coalesce(sum(frags), 0)
+      FROM new_diffs
+      WHERE battles > 0 AND console IS NOT NULL
+      GROUP BY _date, console
+      ON CONFLICT (_date, console, shard) DO UPDATE SET
+        players = r.players + EXCLUDED.players,
+        battles = r.battles + EXCLUDED.battles,
+        wins = r.wins + EXCLUDED.wins,
+        damage_dealt = r.damage_dealt + EXCLUDED.damage_dealt,
+        frags = r.frags + EXCLUDED.frags;
+      INSERT INTO daily_histogram AS h (_date, console, bucket, shard, players)
+      SELECT _date, console, floor(log(2, battles::numeric))::smallint,
+        pg_backend_pid() % {shards}, count(*)
+      FROM new_diffs
+      WHERE battles > 0 AND console IS NOT NULL
+      GROUP BY 1, 2, 3
+      ON CONFLICT (_date, console, bucket, shard) DO UPDATE SET
+        players = h.players + EXCLUDED.players;
+      RETURN NULL;
+    END
+    $func$ LANGUAGE plpgsql;'''
+
+SELECT_DAILY = '''
+    SELECT _date, console, sum(players)::bigint AS players,
+      sum(battles)::bigint AS battles, sum(wins)::bigint AS wins,
+      sum(damage_dealt)::bigint AS damage_dealt, sum(frags)::bigint AS frags
+    FROM daily_rollup
+    WHERE _date >= $1 AND _date <= $2
+    GROUP BY _date, console
+    ORDER BY _date, console'''
+
+SELECT_HISTOGRAM = '''
+    SELECT console, bucket, sum(players)::bigint AS players
+    FROM daily_histogram
+    WHERE _date = $1
+    GROUP BY console, bucket
+    ORDER BY console, bucket'''
+
+
+def bucket_bounds(bucket):
+    r"""
+    :returns: Tuple of the fewest and most battles counted by a bucket
+    """
+    return 2 ** bucket, 2 ** (bucket + 1) - 1
+
+
+async def setup_rollups(conn, shards=8):
+    __ = await conn.execute('''
+        CREATE TABLE IF NOT EXISTS daily_rollup (
+            _date date NOT NULL,
+            console varchar(4) NOT NULL,
+            shard smallint NOT NULL,
+            players integer NOT NULL,
+            battles bigint NOT NULL,
+            wins bigint NOT NULL,
+            damage_dealt bigint NOT NULL,
+            frags bigint NOT NULL,
+            PRIMARY KEY (_date, console, shard))''')
+    __ = await conn.execute('''
+        CREATE TABLE IF NOT EXISTS daily_histogram (
+            _date date NOT NULL,
+            console varchar(4) NOT NULL,
+            bucket smallint NOT NULL,
+            shard smallint NOT NULL,
+            players integer NOT NULL,
+            PRIMARY KEY (_date, console, bucket, shard))''')
+    __ = await conn.execute(ROLLUP_DIFFS.format(shards=shards))
+    __ = await conn.execute('DROP TRIGGER IF EXISTS rollup_diffs ON diff_battles')
+    # Only AFTER statement triggers can reference transition tables
+    __ = await conn.execute(
+        'CREATE TRIGGER rollup_diffs AFTER INSERT ON diff_battles '
+        'REFERENCING NEW TABLE AS new_diffs '
+        'FOR EACH STATEMENT EXECUTE PROCEDURE rollup_diffs();')
+
+
+async def remove_rollups(conn):
+    r"""
+    Stop maintaining rollups. The tables are kept.
+    """
+    __ = await conn.execute('DROP TRIGGER IF EXISTS rollup_diffs ON diff_battles')
+
+
+async def rebuild_rollups(conn, day):
+    r"""
+    Replace the rollups of a day with an aggregate of its `diff_battles`
+    partition, e.g. for days recorded before rollups were set up
+
+    :returns: Number of players active on that day
+    """
+    async with conn.transaction():
+        __ = await conn.execute('DELETE FROM daily_rollup WHERE _date = $1', day)
+        __ = await conn.execute(
+            'DELETE FROM daily_histogram WHERE _date = $1', day)
+        __ = await conn.execute('''
+            INSERT INTO daily_rollup (
+              _date, console, shard, players, battles, wins, damage_dealt,
+              frags)
+            SELECT _date, console, 0, count(*), sum(battles),
+              coalesce(sum(wins), 0), coalesce(sum(damage_dealt), 0),
+              coalesce(sum(frags), 0)
+            FROM diff_battles
+            WHERE _date = $1 AND battles > 0 AND console IS NOT NULL
+            GROUP BY _date, console''', day)
+        __ = await conn.execute('''
+            INSERT INTO daily_histogram (_date, console, bucket, shard, players)
+            SELECT _date, console, floor(log(2, battles::numeric))::smallint,
+              0, count(*)
+            FROM diff_battles
+            WHERE _date = $1 AND battles > 0 AND console IS NOT NULL
+            GROUP BY 1, 2, 3''', day)
+    return await conn.fetchval(
+        'SELECT coalesce(sum(players), 0) FROM daily_rollup WHERE _date = $1',
+        day)
+
+
+async def fetch_daily(conn, first, last=None):
+    r"""
+    :returns: List of dictionaries with the activity of each console on each
+        day from `first` to `last`
+    """
+    records = await conn.fetch(SELECT_DAILY, first, last or first)
+    return [dict(record) for record in records]
+
+
+async def fetch_histogram(conn, day):
+    r"""
+    :returns: Dictionary of console to a list of (fewest battles, most
+        battles, players) for a day
+    """
+    histogram = {}
+    for record in await conn.fetch(SELECT_HISTOGRAM, day):
+        histogram.setdefault(record['console'], []).append(
+            bucket_bounds(record['bucket']) + (record['players'],))
+    return histogram
@@ -0,0 +1,115 @@
+import logging
+from multiprocessing.sharedctypes import RawArray
+
+
+class HelperScaler(object):
+    r"""
+    Adjust the number of active async helpers in each DB helper process
+
+    Every process starts enough helpers to use the whole connection budget,
+    but only the first `targets[process]` of them take results off of the
+    queue. A process closes connections above its target as they are
+    released, and reports how many it has open in `connections[process]`.
+    Connections that are still open after a process scaled down count against
+    the budget until they are closed, so a process only gains a helper while
+    the larger of target and open connections, summed over all processes, is
+    below `connections`.
+
+    The pools of the temporary table merger and of the stats API are not part
+    of this budget.
+
+    A process gains a helper while results are queued up for it and loses one
+    while its queue is empty. Processes with the longest queues are served
+    first. If the average commit latency of a process rises above
+    `max latency`, it loses a helper instead, since the database is not
+    keeping up with the connections it already has.
+
+    :param dict config: 'autoscale' server configuration
+    :param int writers: Number of DB helper processes
+    :param int helpers: Helpers per process to start with
+    """
+
+    def __init__(self, config, writers, helpers):
+        self.budget = max(config.get('connections', writers * helpers), writers)
+        self.min_helpers = config.get('min helpers', 1)
+        # No process can take more than what is left after the others have
+        # their minimum
+        self.max_helpers = min(
+            config.get('max helpers', self.budget),
+            self.budget - (writers - 1) * self.min_helpers)
+        self.busy_frames = config.get('busy frames', 50)
+        self.max_latency = config.get('max latency', 1000)
+        self.targets = RawArray(
+            'i', [max(self.min_helpers, min(helpers, self.budget // writers))] * writers)
+        self.connections = RawArray('i', writers)
+        self.logger = logging.getLogger('WoTServer')
+        self._last = None
+
+    def __len__(self):
+        return sum(self.targets)
+
+    def committed(self, targets=None):
+        r"""
+        :returns: Connections that may be open if every process fills its
+            target
+        """
+        return sum(
+            max(target, connections) for target, connections in zip(
+                targets or self.targets, self.connections))
+
+    def decide(self, queued, latencies):
+        r"""
+        Calculate new targets
+
+        :param list queued: Results waiting in each process' queue
+        :param list latencies: Average commit latency of each process, in ms,
+            since the last decision
+        :returns: List of (process, old target, new target)
+        """
+        targets = list(self.targets)
+        changes = []
+        for writer in sorted(
+                range(len(targets)), key=lambda w: queued[w], reverse=True):
+            old = targets[writer]
+            if latencies[writer] > self.max_latency:
+                new = max(self.min_helpers, old - 1)
+            elif queued[writer] >= old * self.busy_frames:
+                if self.committed(targets) < self.budget:
+                    new = min(self.max_helpers, old + 1)
+                else:
+                    new = old
+            elif not queued[writer]:
+                new = max(self.min_helpers, old - 1)
+            else:
+                new = old
+            if new != old:
+                targets[writer] = new
+                changes.append((writer, old, new))
+        return changes
+
+    def tick(self, queued, stats):
+        r"""
+        Apply a scaling decision based on queue sizes and `WriterStats`
+
+        :returns: List of (process, old target, new target)
+        """
+        totals = stats.totals()
+        last = self._last or [(0, 0, 0)] * len(totals)
+        self._last = totals
+        latencies = [
+            ((seconds - lseconds) / (tx - ltx)) * 1000 if tx > ltx else 0
+            for (__, tx, seconds), (__, ltx, lseconds) in zip(totals, last)]
+        changes = self.decide(queued, latencies)
+        for writer, old, new in changes:
+            self.targets[writer] = new
+            self.logger.info(
+                'Scaling Process-%i from %i to %i helpers (%i queued, '
+                '%.1f ms commits, %i of %i connections)',
+                writer,
+                old,
+                new,
+                queued[writer],
+                latencies[writer],
+                self.committed(),
+                self.budget)
+        return changes
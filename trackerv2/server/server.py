@@ -1,51 +1,72 @@
-import asyncio
-from asyncpg import create_pool, connect
-from collections import deque
+from asyncpg import connect, create_pool
 from datetime import datetime
 from functools import partial
 from ipaddress import ip_address
 from json.decoder import JSONDecodeError
 import linecache
 import logging
-from multiprocessing import Process, Manager, cpu_count
+from statistics import median
+from multiprocessing import Process, Queue, cpu_count
 from os import mkdir, sep
 from os.path import join as pjoin
 from os.path import split as psplit
 from os.path import exists
-from pickle import loads, dumps, UnpicklingError, load, dump, HIGHEST_PROTOCOL
-from queue import Empty
+from pickle import dumps
+from queue import Empty, Full
+from struct import error as StructError
 from sys import exit
+from time import perf_counter, process_time
 from tornado import ioloop, web, websocket
 from tornado.escape import json_decode, json_encode
 import tracemalloc
 
-from database import setup_database
-from utils import genuuid, genhashes, load_config, nested_dd, write_config
-# Import APIResult and Player as we will unpickle them. Ignore unused warnings
-from utils import create_client_config, create_server_config, APIResult, Player
-from utils import expand_debug_access_ips
-from work import setup_work, calculate_total_batches
-
-workgenerator = None
-workpop = 0
-assignedwork = None
-assignedworkcount = 0
-completedcount = 0
-totalbatches = 0
-timeouts = None
-stalework = None
+from backlog import Backlog
+from cache import BattleCache
+from database import setup_database, fetch_window_stats, fetch_account_ids
+from history import write_checkpoint
+from journal import CompletionJournal
+from merge import TempMerger
+from spill import recover_spill, SpillBuffer
+from statsapi import parse_day, StatsReader
+from utils import genuuid, genhashes, load_config, write_config
+from utils import create_client_config, create_server_config
+from utils import expand_debug_access_ips, RESULT_HEADER
+from wheel import TimingWheel
+from scaling import HelperScaler
+from work import platform_ranges, WorkPlanner, STALE
+from writer import result_handler, LockWaits, WriterStats
+
+planner = None
+leasewheel = None
+journal = None
+backlog = None
+spill = None
+merger = None
+cache = None
+writerstats = None
+lockwaits = None
+scaler = None
+statsreader = None
 server_config = None
-received_queue = None
+received_queues = None
+stripe = 16
+helpers = 3
+ack_queue = None
 registered = set()
 startwork = False
+workdone = []
+draining = False
+# Result queues that have been sent the end of the run sentinel
+sentinels = set()
 logger = logging.getLogger('WoTServer')
 telelogger = logging.getLogger('Telemetry')
 statlogger = logging.getLogger('ServerStats')
 db_helpers = None
 allowed_debug = None
+laststats = None
 
 
-def _setupLogging(conf):
+def _setupLogging(conf, writers=1):
     if 'logging' in conf:
         formatter = logging.Formatter(
             '%(asctime)s.%(msecs)03d | %(name)s | %(levelname)-8s | %(message)s',
@@ -113,30 +134,167 @@ def _setupLogging(conf):
         fh.setFormatter(formatter)
         statlogger.addHandler(fh)
         statlogger.setLevel(logging.DEBUG)
-        statlogger.debug('Completed,Stale,Assigned,Queue')
+        statlogger.debug(
+            'Completed,Stale,Assigned,Queue,Backlog Rows,Backlog Bytes,'
+            'Throttled,Spilled Bytes,Spill Drained,Spill Lag (s),'
+            'Dispatches,Dispatch Latency (ms),Cache Hits (%),CPU (%),'
+            'Helpers' + ''.join(
+                ',Writer {0} Rows/s,Writer {0} Transaction (ms),'
+                'Writer {0} Lock Wait (s)'.format(w)
+                for w in range(writers)))
     else:
         nu = logging.NullHandler()
         statlogger.addHandler(nu)
         statlogger.setLevel(logging.ERROR)
 
 
-def move_to_stale(ipaddress, work):
+def move_to_stale():
     r"""
     Work that does not return before the timeout is appended to a queue
     """
-    global assignedworkcount
-    del assignedwork[ipaddress][work[0]]
-    stalework.append(work)
-    assignedworkcount -= 1
+    expired = False
+    for batch in leasewheel.tick():
+        expired |= planner.expire(batch)
+    # Idle clients are not woken by a lease growing old enough to duplicate
+    if expired or (
+            server_config.get('speculative tail', True) and
+            planner.speculation_due(speculative_age())):
+        WorkWSHandler.wake()
+
+
+def speculative_age():
+    return server_config.get('speculative age', server_config['timeout'] / 4)
+
+
+def writer_of(frame):
+    r"""
+    Pick the DB helper process for a result. Each process owns interleaved
+    stripes of consecutive batches, so its writes stay within a few ranges of
+    player IDs and rarely touch the same index pages as another process.
+
+    :returns: Index of the process
+    """
+    return (RESULT_HEADER.unpack_from(frame)[0] // stripe) % len(
+        received_queues)
+
+
+def scale_helpers():
+    scaler.tick([queue.qsize() for queue in received_queues], writerstats)
+
+
+def queue_size():
+    return sum(queue.qsize() for queue in received_queues)
+
+
+def queue_result(frame):
+    r"""
+    Pass a result frame on to the DB helpers. Frames go to the spill buffer
+    instead once too much is held in memory, or while older frames are still
+    waiting on disk.
+
+    :returns: False if the frame could not be queued
+    """
+    if spill is not None and (
+            len(spill) or backlog.bytes - spill.bytes >= spill.memory_limit):
+        spill.append(frame)
+        return True
+    try:
+        received_queues[writer_of(frame)].put_nowait(frame)
+    except Full:
+        if spill is None:
+            return False
+        spill.append(frame)
+    return True
+
+
+def drain_spill():
+    r"""
+    Move spilled frames back to the result queue, oldest first, while there is
+    room for them in memory
+    """
+    while len(spill) and backlog.bytes - spill.bytes < spill.memory_limit:
+        if spill.peek() is None:
+            break
+        frame = spill.peek()[0]
+        try:
+            received_queues[writer_of(frame)].put_nowait(frame)
+        except Full:
+            break
+        spill.pop()
+    spill.sync()
+
+
+def sync_journal():
+    r"""
+    Record batches that the DB helpers have finished with in the journal.
+    Batches that failed to write are handed out again.
+    """
+    written = []
+    while True:
+        try:
+            batch, success = ack_queue.get_nowait()
+        except Empty:
+            break
+        if backlog.remove(batch):
+            logger.info('Result backlog drained. Resuming work dispatch')
+            WorkWSHandler.wake()
+        if success:
+            written.extend(planner.persist(batch))
+        else:
+            logger.warning('Batch %i failed to write. Requeuing', batch)
+            planner.requeue(batch)
+            WorkWSHandler.wake()
+    if written:
+        journal.append(written)
+    journal.sync()
+    if spill is not None:
+        drain_spill()
 
 
 def write_stats():
+    global laststats
+    now = (
+        perf_counter(),
+        process_time(),
+        WorkWSHandler.dispatches,
+        WorkWSHandler.dispatchlatency,
+        spill.drained if spill is not None else 0,
+        *writerstats.values[:],
+        *(lockwaits.seconds if lockwaits is not None else [0] * len(
+            writerstats))
+    )
+    if laststats is None:
+        laststats = now
+    wall, cpu, dispatches, latency, drained, *writers = (
+        current - previous for current, previous in zip(now, laststats))
+    laststats = now
+    writers, waits = writers[:3 * len(writerstats)], writers[
+        3 * len(writerstats):]
+    perwriter = []
+    for (rows, transactions, seconds), waited in zip(
+            zip(*[iter(writers)] * 3), waits):
+        perwriter.append(rows / wall if wall else 0)
+        perwriter.append((seconds / transactions) * 1000 if transactions else 0)
+        perwriter.append(waited)
     statlogger.debug(
-        '%i,%i,%i,%i',
-        completedcount,
-        len(stalework),
-        assignedworkcount,
-        received_queue.qsize()
+        '%i,%i,%i,%i,%i,%i,%i,%i,%i,%.1f,%i,%.3f,%.1f,%.1f,%i' +
+        ',%.0f,%.3f,%.1f' * len(writerstats),
+        planner.completed,
+        planner.stalecount,
+        planner.assigned,
+        queue_size(),
+        backlog.rows,
+        backlog.bytes,
+        backlog.throttled,
+        spill.bytes if spill is not None else 0,
+        drained,
+        spill.lag() if spill is not None else 0,
+        dispatches,
+        (latency / dispatches) * 1000 if dispatches else 0,
+        cache.hit_rate() if cache is not None else 0,
+        (cpu / wall) * 100 if wall else 0,
+        len(scaler) if scaler is not None else len(writerstats) * helpers,
+        *perwriter
     )
 
 
@@ -168,33 +326,128 @@ class DebugHandler(web.RequestHandler):
         elif uri == 'hashes':
             self.write(json_encode(hashes))
         elif uri == 'work':
-            self.write(json_encode(assignedwork))
+            self.write(json_encode(
+                {k: sorted(v) for k, v in planner.held.items() if v}))
         elif uri == 'complete':
-            self.write(f'{completedcount} of {totalbatches}')
+            self.write(f'{planner.completed} of {planner.total}')
+        elif uri == 'skipped':
+            self.write(f'{planner.skipped} of {planner.total}')
+        elif uri == 'packed':
+            self.write(f'{planner.packed} of {planner.total}')
         elif uri == 'queue':
-            self.write(str(received_queue.qsize()))
+            self.write(str(queue_size()))
+        elif uri == 'writers':
+            self.write(json_encode([
+                {
+                    'queue': queue.qsize(),
+                    'rows': rows,
+                    'transactions': transactions,
+                    'latency': (
+                        (seconds / transactions) * 1000 if transactions else 0),
+                    'lock wait': waited
+                }
+                for queue, (rows, transactions, seconds), waited in zip(
+                    received_queues,
+                    writerstats.totals(),
+                    lockwaits.seconds if lockwaits is not None else [None] * len(
+                        writerstats))]))
+        elif uri == 'helpers':
+            if scaler is None:
+                self.write(json_encode([helpers] * len(received_queues)))
+                return
+            self.write(json_encode({
+                'targets': list(scaler.targets),
+                'connections': list(scaler.connections),
+                'budget': scaler.budget}))
+        elif uri == 'backlog':
+            self.write(json_encode({
+                'batches': len(backlog),
+                'rows': backlog.rows,
+                'bytes': backlog.bytes,
+                'throttled': backlog.throttled}))
+        elif uri == 'spill':
+            if spill is None:
+                self.write('Spilling is disabled')
+                return
+            self.write(json_encode({
+                'frames': len(spill),
+                'bytes': spill.bytes,
+                'spilled': spill.spilled,
+                'drained': spill.drained,
+                'lag': spill.lag()}))
+        elif uri == 'cache':
+            if cache is None:
+                self.write('Battle cache is disabled')
+                return
+            self.write(json_encode({
+                'lookups': cache.lookups,
+                'hits': cache.hits,
+                'hit rate': cache.hit_rate()}))
+        elif uri == 'statscache':
+            if statsreader is None:
+                self.write('Stats API is disabled')
+                return
+            self.write(json_encode({
+                'entries': len(statsreader.cache),
+                'hits': statsreader.cache.hits,
+                'misses': statsreader.cache.misses}))
         elif uri == 'registered':
             self.write(str(registered))
         elif uri == 'stale':
-            self.write(str(stalework))
+            self.write(str([
+                planner.work(b) for b in planner.stale
+                if planner.state[b] == STALE]))
         elif uri == 'assignedcount':
-            self.write(str(assignedworkcount))
-        elif uri == 'dump':
-            try:
-                now = datetime.utcnow()
-                with open(now.strftime('recovery-%Y-%m-%d.dump'), 'wb') as f:
-                    dump(
-                        [workpop, completedcount, stalework],
-                        f,
-                        HIGHEST_PROTOCOL
-                    )
-                self.write('Dump successful')
-            except Exception as e:
-                self.write('Exception occurred: {}'.format(e))
+            self.write(str(planner.assigned))
+        elif uri == 'speculative':
+            self.write(str(sorted(planner.speculative)))
+        elif uri == 'written':
+            self.write(f'{planner.written} of {planner.total}')
         else:
             self.write('No debug output for: ' + uri)
 
 
+class StatsHandler(web.RequestHandler):
+    r"""
+    Daily activity per console, read from the rollup tables
+
+    /stats/daily/<day>, /stats/daily/<first day>/<last day> and
+    /stats/histogram/<day>, with days formatted as YYYY-MM-DD
+    """
+
+    def initialize(self, reader):
+        self.reader = reader
+
+    async def get(self, uri, first, last=None):
+        try:
+            first = parse_day(first)
+            last = parse_day(last) if last else None
+            if uri == 'histogram':
+                if last is not None:
+                    raise ValueError('Histograms are for a single day')
+                etag, body = await self.reader.histogram(first)
+            elif last is None:
+                etag, body = await self.reader.daily(first)
+            else:
+                etag, body = await self.reader.days(first, last)
+        except ValueError:
+            self.set_status(400)
+            return
+        except Exception as e:
+            logger.error('Failed to read %s stats: %s', uri, e)
+            self.set_status(503)
+            return
+        self.set_header('Etag', etag)
+        self.set_header(
+            'Cache-Control', 'max-age={}'.format(self.reader.cache.ttl))
+        if self.check_etag_header():
+            # 304 - Not Modified. The client already has this response
+            self.set_status(304)
+            return
+        self.set_header('Content-Type', 'application/json')
+        self.write(body)
+
+
 class UpdateHandler(web.RequestHandler):
     r"""
     Client updates (scripts) as served here
@@ -300,9 +553,16 @@ class WorkWSHandler(websocket.WebSocketHandler):
     Endpoint for delegating work to client machines
     """
 
-    wschecks = dict()
     wsconns = set()
     maxwork = dict()
+    # Connections that ran out of work before filling their window
+    idle = set()
+    # Moving average of seconds between results, per client
+    interval = dict()
+    lastresult = dict()
+    scheduled = None
+    dispatches = 0
+    dispatchlatency = 0.0
 
     def get_compression_options(self):
         # TODO: Read in configuration from server.json
@@ -314,89 +574,146 @@ class WorkWSHandler(websocket.WebSocketHandler):
             self.close()
             return
         logger.info('Worker %s joined', genuuid(client))
-        await self.send_work()
-        WorkWSHandler.wschecks[client] = ioloop.PeriodicCallback(
-            self.send_work, 250)
-        WorkWSHandler.wschecks[client].start()
         WorkWSHandler.wsconns.add(self)
+        await self.send_work(perf_counter())
+
+    @classmethod
+    def wake(cls):
+        r"""
+        Schedule a single dispatch to clients with free slots. Called when
+        work becomes available again, e.g. after a timeout.
+        """
+        if cls.scheduled is None and cls.idle:
+            cls.scheduled = perf_counter()
+            ioloop.IOLoop.current().add_callback(cls.dispatch)
 
-    async def send_work(self):
-        global assignedworkcount
-        global workpop
+    @classmethod
+    async def dispatch(cls):
+        since, cls.scheduled = cls.scheduled, None
+        for conn in tuple(cls.idle):
+            await conn.send_work(since)
+
+    async def send_work(self, since=None):
+        r"""
+        Fill the client's window of outstanding work
+
+        :param float since: `perf_counter` value of the event that triggered
+            this dispatch, for measuring dispatch latency
+        """
         if not startwork:
             return
         if len(workdone):
             self.close()
             return
         client = self.request.remote_ip
-        loop = ioloop.IOLoop.current()
         assignments = []
-        while len(assignedwork[client]) < WorkWSHandler.maxwork[client]:
-            try:
-                work = stalework.pop()
-            except IndexError:
-                try:
-                    work = next(workgenerator)
-                    workpop += 1
-                    if work is None:
-                        raise StopIteration
-                except StopIteration:
-                    if len(stalework) == 0 and assignedworkcount == 0:
-                        workdone.append(True)
-                        logger.info('Work done')
-                    break
+        WorkWSHandler.idle.discard(self)
+        if backlog.throttled:
+            # Hold back new leases until the DB helpers catch up
+            WorkWSHandler.idle.add(self)
+            return
+        while len(planner.held[client]) < WorkWSHandler.maxwork[client]:
+            work = planner.lease(client)
+            if work is None and self.speculative():
+                work = planner.speculate(
+                    client,
+                    speculative_age(),
+                    server_config.get('speculative copies', 2))
+                if work is not None:
+                    logger.debug(
+                        'Duplicating batch %i to %s',
+                        work[0],
+                        genuuid(client))
+                    # The original lease keeps its timeout
+                    assignments.append(work)
+                    continue
+            if work is None:
+                WorkWSHandler.idle.add(self)
+                if planner.finished:
+                    workdone.append(True)
+                    logger.info('Work done')
+                break
             assignments.append(work)
-            assignedwork[client][work[0]] = work
-            timeouts[client][work[0]] = ioloop.IOLoop.current().call_later(
-                server_config['timeout'],
-                move_to_stale,
-                client,
-                work
-            )
-            assignedworkcount += 1
+            leasewheel.add(work[0])
         if assignments:
             await self.write_message(dumps(assignments), True)
+            if since is not None:
+                WorkWSHandler.dispatches += 1
+                WorkWSHandler.dispatchlatency += perf_counter() - since
+
+    def speculative(self):
+        r"""
+        Only clients that return results at least as quickly as the median
+        client may duplicate outstanding work at the end of the run
+        """
+        if not server_config.get('speculative tail', True):
+            return False
+        intervals = [
+            WorkWSHandler.interval[conn.request.remote_ip]
+            for conn in WorkWSHandler.wsconns
+            if conn.request.remote_ip in WorkWSHandler.interval]
+        client = self.request.remote_ip
+        return (
+            client in WorkWSHandler.interval and
+            WorkWSHandler.interval[client] <= median(intervals))
 
     def on_close(self):
         client = self.request.remote_ip
-        WorkWSHandler.wschecks[client].stop()
-        del WorkWSHandler.wschecks[client]
-        WorkWSHandler.wsconns.remove(self)
+        WorkWSHandler.wsconns.discard(self)
+        WorkWSHandler.idle.discard(self)
+        WorkWSHandler.interval.pop(client, None)
+        WorkWSHandler.lastresult.pop(client, None)
         logger.info('Worker %s disconnected', genuuid(client))
 
     async def on_message(self, message):
-        global assignedworkcount
-        global completedcount
+        received = perf_counter()
         client = self.request.remote_ip
+        # Only the header is read here. The pickled result is forwarded to
+        # the DB helpers as is.
         try:
-            results = loads(message)
-            received_queue.put_nowait(results)
-        except UnpicklingError:
+            batch, found = RESULT_HEADER.unpack_from(message)
+        except (StructError, TypeError):
+            batch = 0
+        if not 0 < batch <= planner.total:
             logger.error('Received bad result message from %s', client)
             return
-        try:
-            ioloop.IOLoop.current().remove_timeout(
-                timeouts[client][results.batch]
-            )
-        except AttributeError:
-            # Server got work from a client that is not assigned to it. This
-            # can occur when a client is running on the same machine as the
-            # server, especially if IPv4 and IPv6 is enabled. Avoid using a
-            # target of "localhost" to mitigate this.
-            return
-        # Remove timeout first
-        del timeouts[client][results.batch]
-        try:
-            del assignedwork[client][results.batch]
-        except KeyError:
-            # work has already been moved to stale. How do we correct this?
-            pass
+        if client in WorkWSHandler.lastresult:
+            elapsed = received - WorkWSHandler.lastresult[client]
+            WorkWSHandler.interval[client] = 0.9 * WorkWSHandler.interval.get(
+                client, elapsed) + 0.1 * elapsed
+        WorkWSHandler.lastresult[client] = received
+        # Results are accepted regardless of which client holds the batch.
+        # A result that arrives after its timeout still completes the batch
+        # and cancels the pending re-dispatch. Only results for batches that
+        # are already complete are dropped, so they are not written twice.
+        if planner.complete(batch):
+            leasewheel.discard(batch)
+            if not queue_result(message):
+                logger.warning(
+                    'Result queue is full. Requeuing batch %i', batch)
+                planner.requeue(batch)
+                WorkWSHandler.wake()
+                await self.send_work(received)
+                return
+            if backlog.add(batch, found, len(message)):
+                logger.warning(
+                    'Result backlog at %i players, %i bytes. Pausing work '
+                    'dispatch', backlog.rows, backlog.bytes)
+            extension = planner.observe(batch, found)
+            if extension:
+                # Journal the extension before any of its batches complete
+                journal.append(extension)
+                logger.info(
+                    'Extending platform %i range to %i',
+                    extension[1],
+                    planner.frontiers[extension[1]])
+                WorkWSHandler.wake()
         else:
-            # Don't decrement count unless assigned work is removed
-            assignedworkcount -= 1
-        completedcount += 1
-        # ioloop.IOLoop.current().add_callback(self.send_work)
-        await self.send_work()
+            logger.debug(
+                'Dropping duplicate result for batch %i from %s',
+                batch,
+                client)
+        await self.send_work(received)
 
 
 class TelemetryWSHandler(websocket.WebSocketHandler):
@@ -416,188 +733,173 @@ class TelemetryWSHandler(websocket.WebSocketHandler):
         telelogger.debug(genuuid(self.request.remote_ip) + message)
 
 
-async def send_results_to_database(db_pool, res_queue, work_done, par, chi, tbl='players'):
-    logger = logging.getLogger('WoTServer')
-    logger.debug('Process-%i: Async-%i created', par, chi)
-    if tbl == 'players':
-        command = (
-            'INSERT INTO players ('
-            'account_id, nickname, created_at, last_battle_time, '
-            'updated_at, battles, console, spotted, wins, damage_dealt, '
-            'frags, dropped_capture_points, _last_api_pull) '
-            'VALUES ('
-            '$1::int, '
-            '$2::text, '
-            'to_timestamp($3)::timestamp, '
-            'to_timestamp($4)::timestamp, '
-            'to_timestamp($5)::timestamp, '
-            '$6::int, '
-            '$7::text, '
-            '$8::int, '
-            '$9::int, '
-            '$10::int, '
-            '$11::int, '
-            '$12::int, '
-            'to_timestamp($13)::timestamp) '
-            'ON CONFLICT (account_id) DO UPDATE SET ('
-            'nickname, last_battle_time, updated_at, battles, spotted, wins, '
-            'damage_dealt, frags, dropped_capture_points, _last_api_pull) = ('
-            'EXCLUDED.nickname, '
-            'EXCLUDED.last_battle_time, '
-            'EXCLUDED.updated_at, '
-            'EXCLUDED.battles, '
-            'EXCLUDED.spotted, '
-            'EXCLUDED.wins, '
-            'EXCLUDED.damage_dealt, '
-            'EXCLUDED.frags, '
-            'EXCLUDED.dropped_capture_points, '
-            'EXCLUDED._last_api_pull) '
-            'WHERE players.battles <> EXCLUDED.battles'
-        )
-    else:
-        command = (
-            'INSERT INTO temp_players ('
-            'account_id, nickname, created_at, last_battle_time,'
-            'updated_at, battles, console, spotted, wins, damage_dealt, '
-            'frags, dropped_capture_points, _last_api_pull)'
-            'VALUES ('
-            '$1::int, '
-            '$2::text, '
-            'to_timestamp($3)::timestamp, '
-            'to_timestamp($4)::timestamp, '
-            'to_timestamp($5)::timestamp, '
-            '$6::int, '
-            '$7::text, '
-            '$8::int, '
-            '$9::int, '
-            '$10::int, '
-            '$11::int, '
-            '$12::int, '
-            'to_timestamp($13)::timestamp) '
-            'ON CONFLICT DO NOTHING'
-        )
-    while True:
-        if not res_queue.qsize():
-            if len(work_done):
-                break
-            continue
-        # Use the async here instead of before the `while` statement. Failure
-        # to do so can pin to a specific helper waiting for work instead of
-        # context switching to another that already has something to process
-        async with db_pool.acquire() as conn:
-            try:
-                results = res_queue.get_nowait()
-            except Empty:
-                continue
-            try:
-                __ = await conn.executemany(
-                    command,
-                    tuple((*p, results[1]) for p in results[0])
-                )
-                logger.debug(
-                    'Process-%i: Async-%i submitted batch %i',
-                    par,
-                    chi,
-                    results.batch)
-            except Exception as e:
-                logger.error(
-                    'Process-%i: Async-%i encountered: %s',
-                    par,
-                    chi,
-                    e)
-                with open('error-batch-{}.dump'.format(results.batch), 'wb') as f:
-                    dump(results, f, HIGHEST_PROTOCOL)
-    logger.debug('Process-%i: Async-%i exiting', par, chi)
-
-
-def result_handler(dbconf, res_queue, work_done, par, use_temp=False, pool_size=3):
-    logger = logging.getLogger('WoTServer')
-    # Not availabile until Python 3.7. Use 3.6-compatible syntax for now
-    # asyncio.run(create_helpers(db_pool, res_queue, work_done))
-    logger.debug('Creating event loop')
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    db_pool = loop.run_until_complete(
-        create_pool(min_size=pool_size, max_size=pool_size, **dbconf))
-    logger.debug('Event loop created for Process-%i', par)
-    try:
-        loop.run_until_complete(
-            asyncio.gather(*[
-                send_results_to_database(
-                    db_pool,
-                    res_queue,
-                    work_done,
-                    par,
-                    c,
-                    'players' if not use_temp else 'temp_players')
-                for c in range(pool_size)])
-        )
-    finally:
-        loop.close()
+def advance_from_journal(config, filename):
+    r"""
+    Continue after the furthest batch the previous run wrote. Used by
+    aggressive recovery when the battle cache is on: players whose battle
+    count did not change are not written, so the tables do not show how far
+    the previous run got.
+    """
+    previous = WorkPlanner(config)
+    previous.restore(CompletionJournal.replay(filename))
+    batch = previous.last_written()
+    logger.debug('Last written batch: %s', batch)
+    if batch is not None:
+        planner.seek(min(batch, planner.total) + 1)
 
 
 async def advance_work(config, table='players'):
-    global completedcount
     conn = await connect(**config['database'])
     logger.info('Fetching data from table')
     result = await conn.fetch("SELECT MAX(account_id) FROM {} WHERE _last_api_pull >= '{}'".format(table, datetime.utcnow().strftime('%Y-%m-%d')))
     for record in result:
         max_account = record['max']
     logger.debug('Max account: %i', max_account)
-    while True:
-        popped = next(workgenerator)
-        completedcount += 1
-        if popped[1][0] <= max_account <= popped[1][1]:
-            break
+    batch = planner.batch_of(max_account)
+    if batch is not None:
+        planner.seek(batch + 1)
+
+
+async def fill_cache(config):
+    r"""
+    Load the last known battle count of every player for the DB helpers
+    """
+    conn = await connect(**config['database'])
+    start = perf_counter()
+    # The `players` view of the split schema is slower to read
+    loaded = await cache.load(
+        conn,
+        'player_counters' if config.get('schema', 'legacy') == 'split' else 'players')
+    __ = await conn.close()
+    logger.info(
+        'Loaded %i battle counts in %.1f seconds',
+        loaded,
+        perf_counter() - start)
+
+
+async def plan_run(config):
+    r"""
+    Leave out batches that are not due to be polled in this run
+    """
+    if 'activity tiers' not in config and 'sparse ranges' not in config:
+        return
+    today = datetime.utcnow()
+    ranges = platform_ranges(config)
+    density = await fetch_window_stats(
+        config['database'], ranges, planner.batch_size)
+    if 'activity tiers' in config:
+        skipped = planner.apply_tiers(
+            density, config['activity tiers'], today)
+        logger.info('Skipping %i batches of inactive players', skipped)
+    if 'sparse ranges' in config:
+        skipped = planner.skip_empty(density, config['sparse ranges'], today)
+        logger.info('Skipping %i empty batches', skipped)
+        sparse = planner.sparse_windows(
+            density, config['sparse ranges'], today)
+        accounts = await fetch_account_ids(
+            config['database'], ranges, sparse, planner.batch_size)
+        packed = planner.pack(accounts)
+        logger.info(
+            'Packed %i sparse batches into %i requests',
+            packed + len(planner.packs),
+            len(planner.packs))
 
 
 async def try_exit(config, configpath):
+    global draining
     if len(workdone):
-        if WorkWSHandler.wsconns:
-            for conn in WorkWSHandler.wsconns:
-                conn.close()
-            logger.info('Released all clients')
-        ## We plan on `join`ing anyways
-        # if received_queue.qsize():
-        #     # We still have data to send to the database. Don't exit yet.
-        #     return
-        logger.info('Waiting for DB helpers to complete')
+        if not draining:
+            if WorkWSHandler.wsconns:
+                for conn in tuple(WorkWSHandler.wsconns):
+                    conn.close()
+                logger.info('Released all clients')
+            if spill is not None and len(spill):
+                # Sentinels must be queued behind every spilled result
+                return
+            # Queued behind all results. Each helper passes it on to the next
+            # one in its process. A full queue is retried on the next call
+            # instead of blocking the IOLoop.
+            for index, queue in enumerate(received_queues):
+                if index in sentinels:
+                    continue
+                try:
+                    queue.put_nowait(None)
+                except Full:
+                    continue
+                sentinels.add(index)
+            if len(sentinels) < len(received_queues):
+                return
+            logger.info('Waiting for DB helpers to complete')
+            draining = True
+        # Acknowledgements are still drained into the journal while waiting.
+        # Joining here could deadlock on a helper flushing its ack queue.
+        if any(helper.is_alive() for helper in db_helpers):
+            return
         for helper in db_helpers:
             helper.join()
+        journalcall.stop()
+        leasecall.stop()
+        sync_journal()
+        journal.close()
+        if spill is not None:
+            spill.close()
+        logger.info(
+            '%i of %i batches written to the database',
+            planner.written,
+            planner.total)
         logger.info('Proceeding with post-run cleanup')
         exitcall.stop()
+        if scaler is not None:
+            scalecall.stop()
         if 'stats' in config:
             serverstatcall.stop()
+            lockcall.stop()
+            __ = await lockwaits.conn.close()
+        if statsreader is not None:
+            __ = await statsreader.db_pool.close()
         update = False
         conn = await connect(**config['database'])
-        if config.get('use temp table', False):
-            logger.info('Merging temporary table into primary table')
-            # Suggested solution from https://github.com/MagicStack/asyncpg/pull/295#issuecomment-590079485 while waiting for PR merge
-            for work in setup_work(config):
-                __ = await conn.execute('''
-                    INSERT INTO players (
-                      account_id, nickname, console, created_at,
-                      last_battle_time, updated_at, battles, spotted, wins,
-                      damage_dealt, frags, dropped_capture_points, _last_api_pull)
-                    SELECT * FROM temp_players WHERE account_id BETWEEN $1 AND $2
-                    ON CONFLICT (account_id)
-                    DO UPDATE SET (
-                      nickname, last_battle_time, updated_at, battles,
-                      console, spotted, wins, damage_dealt, frags,
-                      dropped_capture_points, _last_api_pull
-                    ) = (
-                      EXCLUDED.nickname, EXCLUDED.last_battle_time,
-                      EXCLUDED.updated_at, EXCLUDED.battles, EXCLUDED.console,
-                      EXCLUDED.spotted, EXCLUDED.wins, EXCLUDED.damage_dealt,
-                      EXCLUDED.frags, EXCLUDED.dropped_capture_points,
-                      EXCLUDED._last_api_pull)
-                    WHERE players.battles <> EXCLUDED.battles''',
-                    work[1][0],
-                    work[1][1]
-                )
-            __ = await conn.execute('DROP TABLE temp_players')
-            logger.info('Dropped temporary table')
-        if config.get('expand', False):
+        if merger is not None:
+            mergecall.stop()
+            logger.info(
+                'Merging last %i chunks of temporary table into primary '
+                'table. %i were merged during the run',
+                merger.unmerged + len(merger.running),
+                len(merger))
+            __ = await merger.finish()
+            __ = await merger.db_pool.close()
+            if merger.unmerged:
+                logger.error(
+                    'Failed to merge %i chunks. Keeping temporary table',
+                    merger.unmerged)
+            else:
+                __ = await conn.execute('DROP TABLE temp_players')
+                logger.info('Dropped temporary table')
+        history_config = config.get('history', {})
+        if history_config.get('mode', 'full') == 'diff':
+            if merger is not None and merger.unmerged:
+                # `players` does not hold the totals of the whole run
+                logger.error('Skipping history checkpoint')
+            else:
+                start = perf_counter()
+                written = await write_checkpoint(
+                    conn, history_config.get('checkpoint days', 7))
+                if written is not None:
+                    logger.info(
+                        'Wrote history checkpoint of %i players in %.1f '
+                        'seconds',
+                        written,
+                        perf_counter() - start)
+        if 'frontier' in config:
+            # The range has already been probed to the last player found
+            for platform, frontier in zip(('xbox', 'ps4'), planner.frontiers):
+                if frontier > config[platform].get('max account', 0):
+                    config[platform]['max account'] = frontier
+                    update = True
+            if update:
+                logger.info('Expanding max player configuration to frontier')
+                write_config(config, configpath)
+        elif config.get('expand', False):
             logger.info('Checking database to expand players')
             result = await conn.fetch(
                 (
@@ -642,8 +944,11 @@ async def try_exit(config, configpath):
         ioloop.IOLoop.current().stop()
 
 
-def make_app(sfiles, serverconfig, clientconfig):
-    return web.Application([
+def make_app(sfiles, serverconfig, clientconfig, reader=None):
+    stats = [] if reader is None else [
+        (r"/stats/(daily|histogram)/([^/]+)(?:/([^/]+))?", StatsHandler,
+         dict(reader=reader))]
+    return web.Application(stats + [
         (r"/", MainHandler),
         (r"/setup", SetupHandler,
          dict(serverconfig=serverconfig, clientconfig=clientconfig)),
@@ -703,8 +1008,9 @@ if __name__ == '__main__':
     agp.add_argument(
         '-r',
         '--recover',
-        help='Recover server from a previous dump state',
-        type=str)
+        help='Recover server from the completion journal of a previous run',
+        default=False,
+        action='store_true')
     agp.add_argument(
         '--aggressive-recover',
         action='store_true',
@@ -729,31 +1035,68 @@ if __name__ == '__main__':
             pass
 
     # Setup server
-    manager = Manager()
-    workdone = manager.list()
-    received_queue = manager.Queue()
-    workgenerator = setup_work(server_config)
-    totalbatches = calculate_total_batches(server_config)
-    assignedwork = nested_dd()
-    timeouts = nested_dd()
-    stalework = deque()
+    # Frames are passed directly between processes instead of through the
+    # Manager server process
+    # One queue per DB helper process. Results are routed by batch so that
+    # each process writes its own ranges of players.
+    writers = args.processes or 1
+    received_queues = [
+        Queue(max(1, server_config.get('result queue size', 20000) // writers))
+        for __ in range(writers)]
+    stripe = server_config.get('routing', {}).get('stripe batches', 16)
+    writerstats = WriterStats(writers)
+    helpers = args.async_helpers
+    if 'autoscale' in server_config:
+        scaler = HelperScaler(server_config['autoscale'], writers, helpers)
+    ack_queue = Queue()
+    planner = WorkPlanner(server_config)
+    backlog = Backlog(server_config.get('backpressure', {}))
+    leasewheel = TimingWheel(
+        server_config['timeout'],
+        server_config.get('timeout resolution', 1))
     hashes = genhashes(static_files)
     client_config['files'] = list(hashes['win'].keys())
     allowed_debug = expand_debug_access_ips(server_config)
     # TODO: Create a timer to change startwork
     startwork = True
-    _setupLogging(server_config)
+    _setupLogging(server_config, writers)
     if args.trace_memory:
         logger.debug('Starting memory trace')
         tracemalloc.start()
 
+    journal_config = server_config.get('journal', {})
+    journal_file = journal_config.get('file', 'recovery/journal')
     if args.recover:
-        with open(args.recover, 'rb') as f:
-            workpop, completedcount, stalework = load(f)
-            for __ in range(workpop):
-                __ = next(workgenerator)
+        planner.restore(CompletionJournal.replay(journal_file))
+        logger.info(
+            'Recovered %i of %i batches from journal',
+            planner.written,
+            planner.total)
+    if args.aggressive_recover and server_config.get('battle cache', False):
+        # Before the journal of the previous run is truncated
+        advance_from_journal(server_config, journal_file)
+    journal = CompletionJournal(journal_file, args.recover)
+    if 'spill' in server_config:
+        spill = SpillBuffer(
+            server_config['spill'].get('directory', 'spill'),
+            server_config['spill'].get('memory bytes', 256 * 1024 ** 2),
+            server_config['spill'].get('segment bytes', 64 * 1024 ** 2))
+        if len(spill) and args.recover:
+            # Spilled results are written as usual instead of polled again.
+            # Results for batches the journal has as written are removed so
+            # that they are not written twice.
+            dropped = recover_spill(spill, planner, backlog)
+            logger.info(
+                'Recovered %i spilled results. Dropped %i already written',
+                len(spill),
+                dropped)
+        elif len(spill):
+            logger.warning(
+                'Discarding %i spilled results from a previous run. Start '
+                'with --recover to keep them', len(spill))
+            spill.discard()
 
-    if args.aggressive_recover:
+    if args.aggressive_recover and not server_config.get('battle cache', False):
         ioloop.IOLoop.current().run_sync(
             lambda: advance_work(server_config, 'temp_players' if server_config.get('use temp table', False) else 'players'))
 
@@ -762,15 +1105,68 @@ if __name__ == '__main__':
         # Don't set up tables when recovering. We have explicitly coded to exit
         # if the tables already exist. Not sure if we need to modify this
         if not args.recover and not args.aggressive_recover:
-            ioloop.IOLoop.current().run_sync(
+            created, archived = ioloop.IOLoop.current().run_sync(
                 lambda: setup_database(
                     server_config['database'],
-                    server_config.get('use temp table', False)
+                    server_config.get('use temp table', False),
+                    server_config.get('trigger mode', 'row'),
+                    server_config.get('partitions'),
+                    server_config.get('schema', 'legacy'),
+                    server_config.get('history'),
+                    server_config.get('rollups')
                 ))
-        app = make_app(static_files, server_config, client_config)
+            logger.info(
+                'Created %i partitions and archived %i',
+                len(created),
+                len(archived))
+            for name in archived:
+                logger.info('Archived partition %s', name)
+        ioloop.IOLoop.current().run_sync(lambda: plan_run(server_config))
+        if server_config.get('battle cache', False):
+            cache = BattleCache(
+                platform_ranges(server_config), writers)
+            ioloop.IOLoop.current().run_sync(
+                lambda: fill_cache(server_config))
+        if 'stats api' in server_config:
+            stats_config = server_config['stats api']
+            # Separate from the DB helpers' connections and read-only
+            statsreader = StatsReader(
+                ioloop.IOLoop.current().run_sync(lambda: create_pool(
+                    min_size=0,
+                    max_size=stats_config.get('connections', 2),
+                    server_settings={
+                        'application_name': 'wotserver-stats',
+                        'default_transaction_read_only': 'on',
+                        'statement_timeout': str(
+                            stats_config.get('timeout', 5000))},
+                    **server_config['database'])),
+                stats_config)
+        app = make_app(static_files, server_config, client_config, statsreader)
         app.listen(server_config['port'])
         exitcall = ioloop.PeriodicCallback(
-            lambda: try_exit(server_config, args.config), 1000)
+            lambda: try_exit(server_config, args.config),
+            1000)
+        journalcall = ioloop.PeriodicCallback(
+            sync_journal, journal_config.get('interval', 1) * 1000)
+        leasecall = ioloop.PeriodicCallback(
+            move_to_stale, leasewheel.resolution * 1000)
+        if server_config.get('use temp table', False):
+            merge_config = server_config.get('merge', {})
+            merger = TempMerger(
+                planner,
+                ioloop.IOLoop.current().run_sync(lambda: create_pool(
+                    min_size=1,
+                    max_size=merge_config.get('connections', 4),
+                    **server_config['database'])),
+                merge_config.get('batches', 1000),
+                merge_config.get('connections', 4),
+                server_config.get('schema', 'legacy'))
+            mergecall = ioloop.PeriodicCallback(
+                merger.start, merge_config.get('interval', 5) * 1000)
+        if scaler is not None:
+            scalecall = ioloop.PeriodicCallback(
+                scale_helpers,
+                server_config['autoscale'].get('interval', 5) * 1000)
         if 'stats' in server_config:
             if 'interval' not in server_config['stats']:
                 server_config['stats'] = 1
@@ -778,24 +1174,48 @@ if __name__ == '__main__':
                 write_stats,
                 server_config['stats']['interval'] * 1000
             )
+            # Lock waits are sampled from pg_stat_activity on a connection of
+            # their own
+            lock_interval = server_config['stats'].get('lock interval', 1)
+            lock_config = dict(server_config['database'])
+            lock_config['server_settings'] = dict(
+                lock_config.get('server_settings', {}),
+                application_name='wotserver-locks')
+            lockwaits = LockWaits(
+                ioloop.IOLoop.current().run_sync(
+                    lambda: connect(**lock_config)),
+                writers,
+                lock_interval)
+            lockcall = ioloop.PeriodicCallback(
+                lockwaits.sample, lock_interval * 1000)
         db_helpers = [
             Process(
                 target=result_handler,
                 args=(
-                    server_config['database'],
-                    received_queue,
-                    workdone,
+                    server_config,
+                    received_queues[parent],
+                    ack_queue,
                     parent,
-                    server_config.get('use temp table', False),
-                    args.async_helpers
+                    scaler.max_helpers if scaler is not None else helpers,
+                    cache,
+                    writerstats,
+                    scaler.targets if scaler is not None else None,
+                    scaler.connections if scaler is not None else None
                 )
-            ) for parent in range(args.processes or 1)
+            ) for parent in range(writers)
         ]
         for helper in db_helpers:
             helper.start()
         exitcall.start()
+        journalcall.start()
+        leasecall.start()
+        if merger is not None:
+            mergecall.start()
+        if scaler is not None:
+            scalecall.start()
         if 'stats' in server_config:
             serverstatcall.start()
+            lockcall.start()
         logger.info('Starting server')
         ioloop.IOLoop.current().start()
         end = datetime.now()
@@ -806,8 +1226,18 @@ if __name__ == '__main__':
         ioloop.IOLoop.current().stop()
         try:
             exitcall.stop()
+            journalcall.stop()
+            leasecall.stop()
+            if merger is not None:
+                mergecall.stop()
+            if scaler is not None:
+                scalecall.stop()
+            journal.close()
+            if spill is not None:
+                spill.close()
             if 'stats' in server_config:
                 serverstatcall.stop()
+                lockcall.stop()
             for helper in db_helpers:
                 helper.terminate()
         except NameError:
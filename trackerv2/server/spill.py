@@ -0,0 +1,214 @@
+from collections import deque
+from os import fsync, listdir, mkdir, remove, replace
+from os.path import exists
+from os.path import join as pjoin
+from struct import Struct
+from time import time
+
+from utils import RESULT_HEADER
+
+# Prefix of every spilled frame: frame length and time it was spilled
+RECORD_HEADER = Struct('<Id')
+
+
+class SpillBuffer(object):
+    r"""
+    Overflow buffer for result frames that do not fit in memory
+
+    Frames are appended to numbered segment files and read back in the order
+    they were written. Segments are deleted once they are fully read. Segments
+    left behind by a previous run are picked up on start so that their
+    results can still be written to the database.
+
+    :param int memory_limit: Bytes of results to hold in memory before new
+        frames are spilled
+    """
+
+    def __init__(
+            self, directory, memory_limit=256 * 1024 ** 2,
+            segment_size=64 * 1024 ** 2):
+        if not exists(directory):
+            mkdir(directory)
+        self.directory = directory
+        self.memory_limit = memory_limit
+        self.segment_size = segment_size
+        self.segments = deque(sorted(
+            int(name.split('.')[0]) for name in listdir(directory)
+            if name.endswith('.spill')))
+        # Frames and bytes waiting on disk
+        self.frames = 0
+        self.bytes = 0
+        # Totals for this run
+        self.spilled = 0
+        self.drained = 0
+        self._writer = None
+        self._reader = None
+        self._peeked = None
+        for segment in self.segments:
+            with open(self._path(segment), 'rb') as f:
+                for frame, __ in self._records(f):
+                    self.frames += 1
+                    self.bytes += len(frame)
+
+    def __len__(self):
+        return self.frames
+
+    def _path(self, segment):
+        return pjoin(self.directory, '{:08d}.spill'.format(segment))
+
+    @staticmethod
+    def _read(f):
+        position = f.tell()
+        header = f.read(RECORD_HEADER.size)
+        if len(header) == RECORD_HEADER.size:
+            size, spilled_at = RECORD_HEADER.unpack(header)
+            frame = f.read(size)
+            if len(frame) == size:
+                return frame, spilled_at
+        # Incomplete record. Either it is still being written or the server
+        # stopped part way through writing it
+        f.seek(position)
+        return None
+
+    def _records(self, f):
+        while True:
+            record = self._read(f)
+            if record is None:
+                return
+            yield record
+
+    def frames_on_disk(self):
+        r"""
+        Iterate over every frame waiting on disk, oldest first, without
+        draining them
+        """
+        for segment in self.segments:
+            with open(self._path(segment), 'rb') as f:
+                for frame, __ in self._records(f):
+                    yield frame
+
+    def retain(self, keep):
+        r"""
+        Rewrite the segments on disk with only the frames for which `keep`
+        returns True. Must be called before any frames are read or appended.
+
+        :returns: Number of frames removed
+        """
+        removed = 0
+        for segment in self.segments:
+            path = self._path(segment)
+            with open(path, 'rb') as f, open(path + '.tmp', 'wb') as out:
+                for frame, spilled_at in self._records(f):
+                    if keep(frame):
+                        out.write(RECORD_HEADER.pack(len(frame), spilled_at))
+                        out.write(frame)
+                    else:
+                        removed += 1
+                        self.frames -= 1
+                        self.bytes -= len(frame)
+                out.flush()
+                fsync(out.fileno())
+            replace(path + '.tmp', path)
+        return removed
+
+    def append(self, frame):
+        if self._writer is None:
+            segment = self.segments[-1] + 1 if self.segments else 0
+            self.segments.append(segment)
+            self._writer = open(self._path(segment), 'wb')
+        self._writer.write(RECORD_HEADER.pack(len(frame), time()))
+        self._writer.write(frame)
+        self.frames += 1
+        self.bytes += len(frame)
+        self.spilled += len(frame)
+        if self._writer.tell() >= self.segment_size:
+            self._writer.close()
+            self._writer = None
+
+    def sync(self):
+        if self._writer is not None:
+            self._writer.flush()
+            fsync(self._writer.fileno())
+
+    def peek(self):
+        r"""
+        :returns: Tuple of (oldest frame, time it was spilled) or None
+        """
+        if self._peeked is not None:
+            return self._peeked
+        while self.segments:
+            writing = self._writer is not None and len(self.segments) == 1
+            if self._reader is None:
+                self._reader = open(self._path(self.segments[0]), 'rb')
+            if writing:
+                self._writer.flush()
+            self._peeked = self._read(self._reader)
+            if self._peeked is not None:
+                return self._peeked
+            if writing:
+                if self.frames:
+                    return None
+                # Everything has been read. Start a new segment next time so
+                # that this one can be removed.
+                self._writer.close()
+                self._writer = None
+            self._reader.close()
+            self._reader = None
+            remove(self._path(self.segments.popleft()))
+        return None
+
+    def pop(self):
+        r"""
+        Remove the frame returned by `peek`
+        """
+        frame, __ = self._peeked
+        self._peeked = None
+        self.frames -= 1
+        self.bytes -= len(frame)
+        self.drained += 1
+        return frame
+
+    def lag(self):
+        r"""
+        :returns: Seconds since the oldest frame on disk was spilled
+        """
+        record = self.peek()
+        return time() - record[1] if record is not None else 0
+
+    def discard(self):
+        r"""
+        Remove every segment and the frames in them
+        """
+        self.close()
+        while self.segments:
+            remove(self._path(self.segments.popleft()))
+        self._peeked = None
+        self.frames = 0
+        self.bytes = 0
+
+    def close(self):
+        if self._writer is not None:
+            self.sync()
+            self._writer.close()
+            self._writer = None
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+
+
+def recover_spill(spill, planner, backlog):
+    r"""
+    Keep spilled results from a previous run for batches that are not
+    complete yet and add them to the backlog. Results for batches that have
+    already been written, or duplicates of another spilled result, are
+    removed from disk.
+
+    :returns: Number of results removed
+    """
+    def keep(frame):
+        batch, found = RESULT_HEADER.unpack_from(frame)
+        if 0 < batch <= planner.total and planner.complete(batch):
+            backlog.add(batch, found, len(frame))
+            return True
+        return False
+    return spill.retain(keep)
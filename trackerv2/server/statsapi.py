@@ -0,0 +1,151 @@
+r"""
+Cached reads of the daily rollups for the `/stats` endpoints
+
+Responses are cached in the server process, keyed by query, for `ttl`
+seconds. At most `entries` responses are kept; the least recently used one is
+evicted first. Requests for a response that is already being queried wait for
+that query instead of starting their own. Every response carries an ETag so
+that clients can revalidate with If-None-Match without a body being sent.
+
+Queries run on their own small, read-only connection pool so that they never
+take connections from the DB helpers.
+"""
+import asyncio
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from hashlib import sha1
+from time import monotonic
+
+from tornado.escape import json_encode
+
+from rollups import fetch_daily, fetch_histogram
+
+# Longest range of days served by a single request
+MAX_DAYS = 366
+
+
+def parse_day(value):
+    r"""
+    :raises ValueError: If `value` is not formatted as YYYY-MM-DD
+    """
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def etag_of(body):
+    return '"{}"'.format(sha1(body.encode('utf-8')).hexdigest())
+
+
+class TTLCache(object):
+    r"""
+    Least recently used cache whose entries expire after `ttl` seconds
+    """
+
+    def __init__(self, entries=256, ttl=300, clock=monotonic):
+        self.entries = entries
+        self.ttl = ttl
+        self.clock = clock
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key):
+        item = self.items.get(key)
+        if item is None or item[0] <= self.clock():
+            if item is not None:
+                del self.items[key]
+            self.misses += 1
+            return None
+        self.items.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def put(self, key, value):
+        self.items[key] = (self.clock() + self.ttl, value)
+        self.items.move_to_end(key)
+        while len(self.items) > self.entries:
+            self.items.popitem(last=False)
+
+
+def daily_body(records):
+    r"""
+    Group rollup records by day, then console
+    """
+    days = OrderedDict()
+    for record in records:
+        record = dict(record)
+        day = record.pop('_date').isoformat()
+        console = record.pop('console')
+        days.setdefault(day, {})[console] = record
+    return [{'day': day, 'consoles': consoles} for day, consoles in days.items()]
+
+
+class StatsReader(object):
+    r"""
+    Serve aggregates from the rollup tables
+
+    :param db_pool: asyncpg pool reserved for reads
+    :param dict config: 'stats api' server configuration
+    """
+
+    def __init__(self, db_pool, config=None):
+        config = config or {}
+        self.db_pool = db_pool
+        self.cache = TTLCache(config.get('entries', 256), config.get('ttl', 300))
+        self.pending = dict()
+
+    async def fetch(self, key, query):
+        r"""
+        :param key: Hashable key of the query
+        :param query: Coroutine function taking a connection and returning
+            something that can be encoded as JSON
+        :returns: Tuple of (ETag, JSON body)
+        """
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        if key not in self.pending:
+            self.pending[key] = asyncio.ensure_future(self._fetch(key, query))
+        # A client going away does not cancel the query for everyone else
+        return await asyncio.shield(self.pending[key])
+
+    async def _fetch(self, key, query):
+        try:
+            async with self.db_pool.acquire() as conn:
+                body = json_encode(await query(conn))
+            response = (etag_of(body), body)
+            self.cache.put(key, response)
+            return response
+        finally:
+            del self.pending[key]
+
+    async def daily(self, day):
+        async def query(conn):
+            days = daily_body(await fetch_daily(conn, day))
+            return days[0] if days else {'day': day.isoformat(), 'consoles': {}}
+        return await self.fetch(('daily', day), query)
+
+    async def days(self, first, last):
+        r"""
+        :raises ValueError: If the range is reversed or too long
+        """
+        if last < first or last - first >= timedelta(days=MAX_DAYS):
+            raise ValueError('Invalid range of days')
+
+        async def query(conn):
+            return daily_body(await fetch_daily(conn, first, last))
+        return await self.fetch(('days', first, last), query)
+
+    async def histogram(self, day):
+        async def query(conn):
+            return {
+                'day': day.isoformat(),
+                'consoles': {
+                    console: [
+                        {'min': low, 'max': high, 'players': players}
+                        for low, high, players in buckets]
+                    for console, buckets in (
+                        await fetch_histogram(conn, day)).items()}}
+        return await self.fetch(('histogram', day), query)
@@ -4,12 +4,15 @@ from ipaddress import ip_network
 from json import load, dump
 from os import walk
 from os.path import join as pjoin
+from struct import Struct
 from uuid import NAMESPACE_DNS, uuid5
 from typing import NamedTuple
 
 from constants import XBOX_MIN, XBOX_MAX, PS4_MIN, PS4_MAX
 
 BUF_SIZE = 65536
+# Prefix of every result message: batch ID and the number of players found
+RESULT_HEADER = Struct('<IH')
 
 
 def getsha1(filename : str) -> str:
@@ -86,6 +89,17 @@ def create_server_config(filename : str = './config/server.json'):
         'expand': True,
         'max retries': 5,
         'timeout': 15,
+        'timeout resolution': 1,
+        'result queue size': 20000,
+        'backpressure': {
+            'high rows': 1000000,
+            'low rows': 500000,
+            'high bytes': 536870912,
+            'low bytes': 268435456
+        },
+        'speculative tail': True,
+        'speculative age': 5,  # seconds
+        'speculative copies': 2,
         'debug': False,
         'extra tasks': 10,
         'use whitelist': False,
@@ -112,7 +126,31 @@ def create_server_config(filename : str = './config/server.json'):
             'file': 'logs/server-stats-%Y_%m_%d',
             'interval': 1  # seconds
         },
-        'use temp table': False
+        'journal': {
+            'file': 'recovery/journal',
+            'interval': 1  # seconds
+        },
+        'ingest mode': 'executemany',  # or 'copy'
+        'trigger mode': 'row',  # or 'statement'
+        'schema': 'legacy',  # or 'split'
+        'battle cache': False,
+        'routing': {
+            'stripe batches': 16
+        },
+        'history': {
+            'mode': 'full',  # or 'diff'
+            'checkpoint days': 7
+        },
+        'micro batch': {
+            'rows': 5000,
+            'age': 0.5  # seconds
+        },
+        'use temp table': False,
+        'merge': {
+            'batches': 1000,
+            'connections': 4,
+            'interval': 5  # seconds
+        }
     }
     with open(filename, 'w') as f:
         dump(newconfig, f, indent=4)
@@ -0,0 +1,61 @@
+from math import ceil
+
+
+class TimingWheel(object):
+    r"""
+    Hashed timing wheel for expiring work leases
+
+    Instead of scheduling a timer for every lease, leases are dropped into
+    slots of a wheel that advances one slot per `tick`. Adding and cancelling
+    a lease is a set operation and each tick only touches the leases that
+    expire in it. A lease expires between `timeout` and `timeout` +
+    `resolution` seconds after it was added.
+    """
+
+    def __init__(self, timeout, resolution=1.0):
+        self.resolution = resolution
+        self.slots = [
+            set() for __ in range(int(ceil(timeout / resolution)) + 2)]
+        self.position = 0
+        self.entries = dict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def add(self, key):
+        r"""
+        Start (or restart) the timeout for `key`
+        """
+        self.discard(key)
+        # The slot just behind the current position is the last to be reached
+        slot = (self.position - 1) % len(self.slots)
+        self.slots[slot].add(key)
+        self.entries[key] = slot
+
+    def discard(self, key):
+        r"""
+        Cancel the timeout for `key`
+
+        :returns: True if `key` had not expired yet
+        """
+        slot = self.entries.pop(key, None)
+        if slot is None:
+            return False
+        self.slots[slot].discard(key)
+        return True
+
+    def tick(self):
+        r"""
+        Advance the wheel by one slot
+
+        :returns: Keys that have expired
+        """
+        self.position = (self.position + 1) % len(self.slots)
+        expired = self.slots[self.position]
+        self.slots[self.position] = set()
+        for key in expired:
+            del self.entries[key]
+        return expired
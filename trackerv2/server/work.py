@@ -1,17 +1,30 @@
+from array import array
+from bisect import bisect_right
+from collections import defaultdict, deque
+from datetime import timedelta
+from time import monotonic
 
 from constants import XBOX_MIN, XBOX_MAX, PS4_MIN, PS4_MAX
 
+# Batch states tracked by the WorkPlanner
+PENDING = 0
+ASSIGNED = 1
+STALE = 2
+COMPLETE = 3
+WRITTEN = 4
+SKIPPED = 5
+PACKED = 6
 
-def setup_work(config):
-    r"""
-    Create the initial player groups for workers to query
+# Journal entry that precedes (platform, batch count) of a range extension
+EXTEND = 0
 
-    Work is stored in the format of (batch id, tuple(player start ID, player
-    end ID), realm)
 
-    :yields: Work batch
+def platform_ranges(config):
+    r"""
+    Helper function to read the player ID range of each platform
+
+    :returns: Tuple of (player start ID, player end ID) per platform
     """
-    batch_id = 0
     xbox_start_account = XBOX_MIN if 'start account' not in config[
         'xbox'] else config['xbox']['start account']
     xbox_max_account = XBOX_MAX if 'max account' not in config[
@@ -21,11 +34,23 @@ def setup_work(config):
     ps4_max_account = PS4_MAX if 'max account' not in config[
         'ps4'] else config['ps4']['max account']
 
-    constraints = (
+    return (
         (xbox_start_account, xbox_max_account),
         (ps4_start_account, ps4_max_account)
     )
-    for start, end in constraints:
+
+
+def setup_work(config):
+    r"""
+    Create the initial player groups for workers to query
+
+    Work is stored in the format of (batch id, tuple(player start ID, player
+    end ID), realm)
+
+    :yields: Work batch
+    """
+    batch_id = 0
+    for start, end in platform_ranges(config):
         for p in range(start, end, 100):
             batch_id += 1
             yield (batch_id, (p, p + 100))
@@ -37,17 +62,488 @@ def calculate_total_batches(config):
 
     :returns: Total count of 100-player batches
     """
-    xbox_start_account = XBOX_MIN if 'start account' not in config[
-        'xbox'] else config['xbox']['start account']
-    xbox_max_account = XBOX_MAX if 'max account' not in config[
-        'xbox'] else config['xbox']['max account']
-    ps4_start_account = PS4_MIN if 'start account' not in config[
-        'ps4'] else config['ps4']['start account']
-    ps4_max_account = PS4_MAX if 'max account' not in config[
-        'ps4'] else config['ps4']['max account']
-
     # Negation to convert floor division to ceiling division
-    return (
-        -(-(xbox_max_account - xbox_start_account) // 100) +
-        (-(-(ps4_max_account - ps4_start_account) // 100))
-    )
+    return sum(
+        -(-(end - start) // 100) for start, end in platform_ranges(config))
+
+
+class WorkPlanner(object):
+    r"""
+    Seekable replacement for `setup_work` that also tracks batch progress
+
+    Batch IDs are identical to those yielded by `setup_work` and are mapped to
+    their player ID range arithmetically, so any batch can be looked up or
+    skipped to without walking the ones before it. The state of every batch
+    is kept in a single byte of a `bytearray`; only in-flight leases are held
+    in dictionaries, so memory does not grow with the number of completed
+    batches.
+    """
+
+    def __init__(self, config, batch_size=100):
+        self.batch_size = batch_size
+        # First batch ID, first player ID, end player ID, batch count and
+        # platform of each segment. There is one segment per platform, plus
+        # one for every time a platform's range is extended.
+        self._firsts = []
+        self._starts = []
+        self._ends = []
+        self._sizes = []
+        self._platforms = []
+        self.total = 0
+        ranges = platform_ranges(config)
+        for platform, (start, end) in enumerate(ranges):
+            self._firsts.append(self.total + 1)
+            self._starts.append(start)
+            self._ends.append(end)
+            self._sizes.append(-(-(end - start) // batch_size))
+            self._platforms.append(platform)
+            self.total += self._sizes[-1]
+        # Batch IDs start at 1. Index 0 is left unused
+        self.state = bytearray(self.total + 1)
+        self.counts = [self.total, 0, 0, 0, 0, 0, 0]
+        # Highest player ID scanned so far for each platform. A platform may
+        # not grow into the range of the platform after it.
+        self.frontiers = [
+            start + size * batch_size
+            for (start, __), size in zip(ranges, self._sizes)]
+        self._limits = [start for start, __ in ranges[1:]] + [None]
+        self.lookahead = config.get('frontier', {}).get('empty batches', 0)
+        self.cursor = 1
+        self.stale = deque()
+        # Leases are kept in the order they were handed out
+        self.leases = dict()
+        self.leased_at = dict()
+        self.clock = monotonic
+        self.speculative = dict()
+        self.held = defaultdict(set)
+        # Batches that are polled together with a lead batch, by lead batch
+        self.members = dict()
+        self.packs = dict()
+
+    def __len__(self):
+        return self.total
+
+    @property
+    def completed(self):
+        return self.counts[COMPLETE] + self.counts[WRITTEN]
+
+    @property
+    def written(self):
+        return self.counts[WRITTEN]
+
+    @property
+    def skipped(self):
+        return self.counts[SKIPPED]
+
+    @property
+    def packed(self):
+        return self.counts[PACKED]
+
+    @property
+    def assigned(self):
+        return self.counts[ASSIGNED]
+
+    @property
+    def stalecount(self):
+        return self.counts[STALE]
+
+    @property
+    def finished(self):
+        r"""
+        All batches are either complete or skipped and none are outstanding
+        """
+        return not (
+            self.counts[PENDING] or
+            self.counts[ASSIGNED] or
+            self.counts[STALE])
+
+    def _segment(self, batch):
+        return bisect_right(self._firsts, batch) - 1
+
+    def _set(self, batch, state):
+        self.counts[self.state[batch]] -= 1
+        self.counts[state] += 1
+        self.state[batch] = state
+
+    def work(self, batch):
+        r"""
+        Convert a batch ID into the work format used by `setup_work`. Packed
+        batches also carry the explicit player IDs to query.
+        """
+        if not 0 < batch <= self.total:
+            raise IndexError('Batch {} out of range'.format(batch))
+        segment = self._segment(batch)
+        start = self._starts[segment] + (
+            batch - self._firsts[segment]) * self.batch_size
+        if batch in self.packs:
+            return (
+                batch,
+                (start, start + self.batch_size),
+                tuple(self.packs[batch]))
+        return (batch, (start, start + self.batch_size))
+
+    def chunks(self, size):
+        r"""
+        Split every segment into ranges of at most `size` consecutive batches
+
+        :yields: Tuple of (first batch, end batch, (player start ID, player
+            end ID)). The end batch is exclusive.
+        """
+        for first, start, count in zip(
+                self._firsts, self._starts, self._sizes):
+            for offset in range(0, count, size):
+                end = min(offset + size, count)
+                yield (
+                    first + offset,
+                    first + end,
+                    (start + offset * self.batch_size,
+                     start + end * self.batch_size))
+
+    def settled(self, first, end):
+        r"""
+        :returns: True if every batch from `first` up to `end` is written to
+            the database or skipped
+        """
+        states = self.state[first:end]
+        return states.count(WRITTEN) + states.count(SKIPPED) == end - first
+
+    def batch_of(self, account_id):
+        r"""
+        Find the batch ID that contains a player ID
+
+        :returns: Batch ID or None if the player is outside of all ranges
+        """
+        for first, start, end in zip(self._firsts, self._starts, self._ends):
+            if start <= account_id < end:
+                return first + (account_id - start) // self.batch_size
+        return None
+
+    def seek(self, batch):
+        r"""
+        Mark every batch before `batch` that has not been handed out as
+        complete and continue handing out work from `batch`
+        """
+        batch = max(1, min(batch, self.total + 1))
+        for b in range(self.cursor, batch):
+            if self.state[b] == PENDING:
+                self._set(b, WRITTEN)
+        self.cursor = max(self.cursor, batch)
+
+    def last_written(self):
+        r"""
+        :returns: Highest batch recorded as written or None
+        """
+        batch = self.state.rfind(WRITTEN)
+        return batch if batch > 0 else None
+
+    def extend(self, platform, count):
+        r"""
+        Append `count` batches to the end of a platform's range. The new
+        batches are numbered after every existing batch.
+        """
+        start = self.frontiers[platform]
+        self._firsts.append(self.total + 1)
+        self._starts.append(start)
+        self._ends.append(start + count * self.batch_size)
+        self._sizes.append(count)
+        self._platforms.append(platform)
+        self.state.extend(bytes(count))
+        self.counts[PENDING] += count
+        self.total += count
+        self.frontiers[platform] = self._ends[-1]
+
+    def observe(self, batch, found):
+        r"""
+        Keep probing past the end of a platform's range while batches near the
+        end return players. The range always reaches `lookahead` batches past
+        the highest batch that returned players, so probing stops after that
+        many consecutive empty batches.
+
+        :param int found: Number of players returned for the batch
+        :returns: Journal entry for the extension, or an empty tuple
+        """
+        if not found or not self.lookahead or batch in self.packs:
+            return ()
+        segment = self._segment(batch)
+        platform = self._platforms[segment]
+        end = self.work(batch)[1][1] + self.lookahead * self.batch_size
+        if self._limits[platform] is not None:
+            end = min(end, self._limits[platform])
+        if end <= self.frontiers[platform]:
+            return ()
+        count = -(-(end - self.frontiers[platform]) // self.batch_size)
+        self.extend(platform, count)
+        return (EXTEND, platform, count)
+
+    def skip(self, batch):
+        r"""
+        Leave a batch out of this run if it has not been handed out yet
+        """
+        if self.state[batch] == PENDING:
+            self._set(batch, SKIPPED)
+
+    def apply_tiers(self, activity, tiers, today):
+        r"""
+        Skip batches whose players have not played recently. Batches are
+        sorted into tiers by their most recent battle: hot batches are polled
+        every run and warm and cold batches every `warm period` and `cold
+        period` runs, respectively. Each run polls a different slice of the
+        warm and cold tiers so that every batch is eventually refreshed.
+
+        :param list activity: One dictionary per platform, mapping the index
+            of a batch within the platform to a tuple of (player count, most
+            recent battle time)
+        :param dict tiers: 'activity tiers' server configuration
+        :param datetime today: Time of the run
+        :returns: Number of batches skipped
+        """
+        hot = timedelta(days=tiers.get('hot days', 14))
+        warm = timedelta(days=tiers.get('warm days', 90))
+        warm_period = tiers.get('warm period', 7)
+        cold_period = tiers.get('cold period', 30)
+        day = today.toordinal()
+        before = self.skipped
+        for first, size, windows in zip(self._firsts, self._sizes, activity):
+            for window, (__, last_battle) in windows.items():
+                if not 0 <= window < size:
+                    continue
+                age = today - last_battle
+                if age <= hot:
+                    continue
+                period = warm_period if age <= warm else cold_period
+                if (first + window + day) % period:
+                    self.skip(first + window)
+        return self.skipped - before
+
+    def skip_empty(self, density, config, today):
+        r"""
+        Skip batches that have never returned a player. Only batches below the
+        highest batch with players are skipped, leaving unexplored ranges
+        alone. Each run probes a different slice of the empty batches so that
+        new players are still found.
+
+        :param list density: Same format as `activity` in `apply_tiers`
+        :param dict config: 'sparse ranges' server configuration
+        :param datetime today: Time of the run
+        :returns: Number of batches skipped
+        """
+        probe_period = config.get('probe period', 30)
+        day = today.toordinal()
+        before = self.skipped
+        for first, size, windows in zip(self._firsts, self._sizes, density):
+            if not windows:
+                continue
+            for window in range(min(max(windows), size)):
+                if window in windows:
+                    continue
+                if (first + window + day) % probe_period:
+                    self.skip(first + window)
+        return self.skipped - before
+
+    def sparse_windows(self, density, config, today):
+        r"""
+        Find batches with few known players that are worth packing together
+
+        :returns: One list of batch indexes per platform
+        """
+        limit = config.get('sparse accounts', 20)
+        probe_period = config.get('probe period', 30)
+        day = today.toordinal()
+        sparse = []
+        for first, size, windows in zip(self._firsts, self._sizes, density):
+            sparse.append(sorted(
+                window for window, (accounts, __) in windows.items()
+                if 0 <= window < size and accounts <= limit and
+                self.state[first + window] == PENDING and
+                # Probed batches are polled in full to find new players
+                (first + window + day) % probe_period))
+        return sparse
+
+    def pack(self, accounts, limit=100):
+        r"""
+        Combine the known players of sparse batches into as few requests as
+        possible. The first batch of each pack leads it; the others are
+        completed along with it.
+
+        :param list accounts: One sorted list of player IDs per platform, as
+            returned by `database.fetch_account_ids`
+        :returns: Number of requests saved
+        """
+        before = self.packed
+        for first, start, ids in zip(self._firsts, self._starts, accounts):
+            windows = defaultdict(list)
+            for account_id in ids:
+                windows[(account_id - start) // self.batch_size].append(
+                    account_id)
+            batches, pack = [], []
+            for window in sorted(windows):
+                if len(pack) + len(windows[window]) > limit:
+                    self._pack(batches, pack)
+                    batches, pack = [], []
+                batches.append(first + window)
+                pack.extend(windows[window])
+            self._pack(batches, pack)
+        return self.packed - before
+
+    def _pack(self, batches, pack):
+        if len(batches) < 2:
+            return
+        lead, members = batches[0], tuple(batches[1:])
+        for batch in members:
+            self._set(batch, PACKED)
+        self.members[lead] = members
+        self.packs[lead] = array('I', pack)
+
+    def requeue(self, batch):
+        r"""
+        Place a batch back in the queue to be handed out before new work
+        """
+        if self.state[batch] == STALE:
+            return
+        self._release(batch)
+        self._set(batch, STALE)
+        self.stale.append(batch)
+
+    def next_batch(self):
+        r"""
+        Find the next batch to hand out. Stale work takes priority.
+
+        :returns: Batch ID or None if there is no available work
+        """
+        while self.stale:
+            batch = self.stale.pop()
+            # Entries are left in the deque when stale work completes late
+            if self.state[batch] == STALE:
+                return batch
+        while self.cursor <= self.total:
+            batch = self.cursor
+            self.cursor += 1
+            if self.state[batch] == PENDING:
+                return batch
+        return None
+
+    def assign(self, batch, client):
+        self._set(batch, ASSIGNED)
+        self.leases[batch] = client
+        self.leased_at[batch] = self.clock()
+        self.held[client].add(batch)
+        return self.work(batch)
+
+    def lease(self, client):
+        r"""
+        Assign the next available batch to a client
+
+        :returns: Work batch or None if there is no available work
+        """
+        batch = self.next_batch()
+        if batch is None:
+            return None
+        return self.assign(batch, client)
+
+    def speculate(self, client, min_age=0, limit=None):
+        r"""
+        Duplicate the oldest outstanding lease that is held by a different
+        client. Used at the end of a run so that batches held by slow or dead
+        clients do not have to wait for a timeout.
+
+        :param float min_age: Seconds a lease must have been held for before
+            it is duplicated
+        :param int limit: Most duplicates a client may hold at once
+        :returns: Work batch or None if there is nothing to duplicate
+        """
+        if limit is not None and sum(
+                1 for batch in self.held[client]
+                if self.speculative.get(batch) == client) >= limit:
+            return None
+        oldest = self.clock() - min_age
+        for batch, holder in self.leases.items():
+            # Every lease after this one is younger
+            if self.leased_at[batch] > oldest:
+                break
+            if holder != client and batch not in self.speculative:
+                self.speculative[batch] = client
+                self.held[client].add(batch)
+                return self.work(batch)
+        return None
+
+    def speculation_due(self, min_age=0):
+        r"""
+        :returns: True if there is no work left to lease and the oldest lease
+            that has not been duplicated was handed out at least `min_age`
+            seconds ago
+        """
+        if self.counts[PENDING] or self.counts[STALE]:
+            return False
+        oldest = self.clock() - min_age
+        for batch in self.leases:
+            if self.leased_at[batch] > oldest:
+                break
+            if batch not in self.speculative:
+                return True
+        return False
+
+    def _release(self, batch):
+        client = self.leases.pop(batch, None)
+        self.leased_at.pop(batch, None)
+        if client is not None:
+            self.held[client].discard(batch)
+        duplicate = self.speculative.pop(batch, None)
+        if duplicate is not None:
+            self.held[duplicate].discard(batch)
+        return client
+
+    def expire(self, batch):
+        r"""
+        Move an assigned batch to the stale queue
+
+        :returns: True if the batch was still outstanding
+        """
+        if self.state[batch] != ASSIGNED:
+            return False
+        self.requeue(batch)
+        return True
+
+    def complete(self, batch):
+        r"""
+        Record the result of a batch
+
+        :returns: True if this is the first result for the batch
+        """
+        if self.state[batch] in (COMPLETE, WRITTEN):
+            return False
+        self._release(batch)
+        self._set(batch, COMPLETE)
+        for member in self.members.get(batch, ()):
+            self._set(member, COMPLETE)
+        return True
+
+    def persist(self, batch):
+        r"""
+        Record that the result of a batch has been written to the database
+
+        :returns: The batch and the members of its pack that were recorded
+        """
+        if self.state[batch] == WRITTEN:
+            return ()
+        self._release(batch)
+        self._set(batch, WRITTEN)
+        members = self.members.get(batch, ())
+        for member in members:
+            self._set(member, WRITTEN)
+        return (batch,) + members
+
+    def restore(self, batches):
+        r"""
+        Rebuild progress from the batches recorded in a completion journal.
+        Everything else, including work that was in flight, is handed out
+        again.
+        """
+        entries = iter(batches)
+        for batch in entries:
+            if batch == EXTEND:
+                platform, count = next(entries, None), next(entries, None)
+                if count is None:
+                    break
+                self.extend(platform, count)
+            elif batch <= self.total:
+                self.persist(batch)
@@ -0,0 +1,587 @@
+import asyncio
+from asyncpg import create_pool
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import logging
+from multiprocessing.sharedctypes import RawArray
+from operator import itemgetter
+from pickle import loads
+from queue import Empty
+from time import perf_counter
+
+from utils import RESULT_HEADER
+
+# Order of the fields of a result row: a Player followed by the time of the
+# API pull
+PLAYER_COLUMNS = (
+    'account_id', 'nickname', 'created_at', 'last_battle_time', 'updated_at',
+    'battles', 'console', 'spotted', 'wins', 'damage_dealt', 'frags',
+    'dropped_capture_points', '_last_api_pull'
+)
+
+UPSERT_PLAYERS = (
+    'INSERT INTO players ('
+    'account_id, nickname, created_at, last_battle_time, '
+    'updated_at, battles, console, spotted, wins, damage_dealt, '
+    'frags, dropped_capture_points, _last_api_pull) '
+    'VALUES ('
+    '$1::int, '
+    '$2::text, '
+    'to_timestamp($3)::timestamp, '
+    'to_timestamp($4)::timestamp, '
+    'to_timestamp($5)::timestamp, '
+    '$6::int, '
+    '$7::text, '
+    '$8::int, '
+    '$9::int, '
+    '$10::int, '
+    '$11::int, '
+    '$12::int, '
+    'to_timestamp($13)::timestamp) '
+    'ON CONFLICT (account_id) DO UPDATE SET ('
+    'nickname, last_battle_time, updated_at, battles, spotted, wins, '
+    'damage_dealt, frags, dropped_capture_points, _last_api_pull) = ('
+    'EXCLUDED.nickname, '
+    'EXCLUDED.last_battle_time, '
+    'EXCLUDED.updated_at, '
+    'EXCLUDED.battles, '
+    'EXCLUDED.spotted, '
+    'EXCLUDED.wins, '
+    'EXCLUDED.damage_dealt, '
+    'EXCLUDED.frags, '
+    'EXCLUDED.dropped_capture_points, '
+    'EXCLUDED._last_api_pull) '
+    'WHERE players.battles <> EXCLUDED.battles'
+)
+
+INSERT_TEMP_PLAYERS = (
+    'INSERT INTO temp_players ('
+    'account_id, nickname, created_at, last_battle_time,'
+    'updated_at, battles, console, spotted, wins, damage_dealt, '
+    'frags, dropped_capture_points, _last_api_pull)'
+    'VALUES ('
+    '$1::int, '
+    '$2::text, '
+    'to_timestamp($3)::timestamp, '
+    'to_timestamp($4)::timestamp, '
+    'to_timestamp($5)::timestamp, '
+    '$6::int, '
+    '$7::text, '
+    '$8::int, '
+    '$9::int, '
+    '$10::int, '
+    '$11::int, '
+    '$12::int, '
+    'to_timestamp($13)::timestamp) '
+    'ON CONFLICT DO NOTHING'
+)
+
+# Rows are copied in with the same types that clients send. Timestamps are
+# converted while merging so that both ingest modes store identical values.
+# Temporary tables are never WAL-logged, and ON COMMIT DELETE ROWS empties
+# the table after every merge.
+CREATE_STAGING = '''
+    CREATE TEMPORARY TABLE IF NOT EXISTS staging_players (
+        account_id integer,
+        nickname text,
+        created_at double precision,
+        last_battle_time double precision,
+        updated_at double precision,
+        battles integer,
+        console text,
+        spotted integer,
+        wins integer,
+        damage_dealt integer,
+        frags integer,
+        dropped_capture_points integer,
+        _last_api_pull double precision
+    ) ON COMMIT DELETE ROWS'''
+
+# A player may only be affected once per INSERT. Keep the latest pull.
+SELECT_STAGING = (
+    'SELECT DISTINCT ON (account_id) '
+    'account_id, nickname, to_timestamp(created_at)::timestamp AS created_at, '
+    'to_timestamp(last_battle_time)::timestamp AS last_battle_time, '
+    'to_timestamp(updated_at)::timestamp AS updated_at, battles, console, '
+    'spotted, wins, damage_dealt, frags, dropped_capture_points, '
+    'to_timestamp(_last_api_pull)::timestamp AS _last_api_pull '
+    'FROM staging_players '
+    'ORDER BY account_id, _last_api_pull DESC'
+)
+
+MERGE_PLAYERS = (
+    'INSERT INTO players ('
+    'account_id, nickname, created_at, last_battle_time, '
+    'updated_at, battles, console, spotted, wins, damage_dealt, '
+    'frags, dropped_capture_points, _last_api_pull) ' + SELECT_STAGING + ' '
+    'ON CONFLICT (account_id) DO UPDATE SET ('
+    'nickname, last_battle_time, updated_at, battles, spotted, wins, '
+    'damage_dealt, frags, dropped_capture_points, _last_api_pull) = ('
+    'EXCLUDED.nickname, '
+    'EXCLUDED.last_battle_time, '
+    'EXCLUDED.updated_at, '
+    'EXCLUDED.battles, '
+    'EXCLUDED.spotted, '
+    'EXCLUDED.wins, '
+    'EXCLUDED.damage_dealt, '
+    'EXCLUDED.frags, '
+    'EXCLUDED.dropped_capture_points, '
+    'EXCLUDED._last_api_pull) '
+    'WHERE players.battles <> EXCLUDED.battles'
+)
+
+MERGE_TEMP_PLAYERS = (
+    'INSERT INTO temp_players ('
+    'account_id, nickname, created_at, last_battle_time, '
+    'updated_at, battles, console, spotted, wins, damage_dealt, '
+    'frags, dropped_capture_points, _last_api_pull) ' + SELECT_STAGING + ' '
+    'ON CONFLICT DO NOTHING'
+)
+
+
+# Split schema. Identity is only written for new players and changed
+# nicknames; existing players never take a row lock on `player_identity`.
+UPSERT_IDENTITY = (
+    'INSERT INTO player_identity (account_id, nickname, console, created_at) '
+    'SELECT $1::int, $2::text, $3::text, to_timestamp($4)::timestamp '
+    'WHERE NOT EXISTS ('
+    'SELECT 1 FROM player_identity '
+    'WHERE account_id = $1::int AND nickname = $2::text) '
+    'ON CONFLICT (account_id) DO UPDATE SET nickname = EXCLUDED.nickname '
+    'WHERE player_identity.nickname <> EXCLUDED.nickname'
+)
+
+UPSERT_COUNTERS = (
+    'INSERT INTO player_counters ('
+    'account_id, last_battle_time, updated_at, battles, spotted, wins, '
+    'damage_dealt, frags, dropped_capture_points, _last_api_pull) '
+    'VALUES ('
+    '$1::int, '
+    'to_timestamp($2)::timestamp, '
+    'to_timestamp($3)::timestamp, '
+    '$4::int, '
+    '$5::int, '
+    '$6::int, '
+    '$7::int, '
+    '$8::int, '
+    '$9::int, '
+    'to_timestamp($10)::timestamp) '
+    'ON CONFLICT (account_id) DO UPDATE SET ('
+    'last_battle_time, updated_at, battles, spotted, wins, damage_dealt, '
+    'frags, dropped_capture_points, _last_api_pull) = ('
+    'EXCLUDED.last_battle_time, '
+    'EXCLUDED.updated_at, '
+    'EXCLUDED.battles, '
+    'EXCLUDED.spotted, '
+    'EXCLUDED.wins, '
+    'EXCLUDED.damage_dealt, '
+    'EXCLUDED.frags, '
+    'EXCLUDED.dropped_capture_points, '
+    'EXCLUDED._last_api_pull) '
+    'WHERE player_counters.battles <> EXCLUDED.battles'
+)
+
+MERGE_IDENTITY = (
+    'INSERT INTO player_identity (account_id, nickname, console, created_at) '
+    'SELECT s.account_id, s.nickname, s.console, s.created_at '
+    'FROM (' + SELECT_STAGING + ') s '
+    'LEFT JOIN player_identity i USING (account_id) '
+    'WHERE i.nickname IS DISTINCT FROM s.nickname '
+    'ON CONFLICT (account_id) DO UPDATE SET nickname = EXCLUDED.nickname '
+    'WHERE player_identity.nickname <> EXCLUDED.nickname'
+)
+
+MERGE_COUNTERS = (
+    'INSERT INTO player_counters ('
+    'account_id, last_battle_time, updated_at, battles, spotted, wins, '
+    'damage_dealt, frags, dropped_capture_points, _last_api_pull) '
+    'SELECT account_id, last_battle_time, updated_at, battles, spotted, wins, '
+    'damage_dealt, frags, dropped_capture_points, _last_api_pull '
+    'FROM (' + SELECT_STAGING + ') s '
+    'ON CONFLICT (account_id) DO UPDATE SET ('
+    'last_battle_time, updated_at, battles, spotted, wins, damage_dealt, '
+    'frags, dropped_capture_points, _last_api_pull) = ('
+    'EXCLUDED.last_battle_time, '
+    'EXCLUDED.updated_at, '
+    'EXCLUDED.battles, '
+    'EXCLUDED.spotted, '
+    'EXCLUDED.wins, '
+    'EXCLUDED.damage_dealt, '
+    'EXCLUDED.frags, '
+    'EXCLUDED.dropped_capture_points, '
+    'EXCLUDED._last_api_pull) '
+    'WHERE player_counters.battles <> EXCLUDED.battles'
+)
+
+
+def identity_rows(rows):
+    return tuple((row[0], row[1], row[6], row[2]) for row in rows)
+
+
+def counter_rows(rows):
+    return tuple((row[0], *row[3:6], *row[7:]) for row in rows)
+
+
+async def setup_staging(conn):
+    r"""
+    Connection setup for the COPY ingest mode
+    """
+    __ = await conn.execute(CREATE_STAGING)
+
+
+async def write_executemany(conn, rows, tbl='players', schema='legacy'):
+    r"""
+    Upsert rows with one parameterized statement per player
+    """
+    if tbl == 'players' and schema == 'split':
+        # Identity first, so that counter triggers can find the console
+        __ = await conn.executemany(UPSERT_IDENTITY, identity_rows(rows))
+        __ = await conn.executemany(UPSERT_COUNTERS, counter_rows(rows))
+        return
+    __ = await conn.executemany(
+        UPSERT_PLAYERS if tbl == 'players' else INSERT_TEMP_PLAYERS,
+        rows
+    )
+
+
+async def write_copy(conn, rows, tbl='players', schema='legacy'):
+    r"""
+    Stream rows into the staging table with binary COPY, then merge them with
+    a single set-based statement
+
+    Must be called inside of a transaction. The staging table is emptied when
+    it commits.
+    """
+    __ = await conn.copy_records_to_table(
+        'staging_players',
+        records=rows,
+        columns=PLAYER_COLUMNS
+    )
+    if tbl == 'players' and schema == 'split':
+        __ = await conn.execute(MERGE_IDENTITY)
+        __ = await conn.execute(MERGE_COUNTERS)
+        return
+    __ = await conn.execute(
+        MERGE_PLAYERS if tbl == 'players' else MERGE_TEMP_PLAYERS)
+
+
+# DB helper connections waiting on a lock held by another transaction, by
+# process
+LOCK_WAITS = r'''
+    SELECT substring(application_name FROM 'wotserver-writer-(\d+)')::integer
+      AS writer, count(*) AS waiting
+    FROM pg_stat_activity
+    WHERE wait_event_type = 'Lock' AND
+      application_name LIKE 'wotserver-writer-%'
+    GROUP BY 1'''
+
+INGEST_MODES = {
+    'executemany': write_executemany,
+    'copy': write_copy
+}
+
+
+def unpack_rows(frame):
+    r"""
+    Convert a result frame to rows for the database
+
+    :returns: Tuple of (batch ID, rows)
+    """
+    batch, __ = RESULT_HEADER.unpack_from(frame)
+    results = loads(frame[RESULT_HEADER.size:])
+    return batch, tuple((*p, results[1]) for p in results[0])
+
+
+async def collect_frames(res_queue, executor, max_rows, max_age):
+    r"""
+    Gather result frames into a micro-batch
+
+    Blocks until the first frame arrives, then keeps collecting until the
+    micro-batch holds `max_rows` players or `max_age` seconds have passed
+    since the first frame.
+
+    :returns: Tuple of (frames, whether the end of the run was signaled)
+    """
+    loop = asyncio.get_event_loop()
+    # Block in a worker thread until a frame arrives, leaving the event loop
+    # free for the other helpers. `None` signals the end of the run.
+    frame = await loop.run_in_executor(executor, res_queue.get)
+    if frame is None:
+        return [], True
+    frames = [frame]
+    rows = RESULT_HEADER.unpack_from(frame)[1]
+    deadline = perf_counter() + max_age
+    while rows < max_rows:
+        remaining = deadline - perf_counter()
+        if remaining <= 0:
+            break
+        try:
+            frame = res_queue.get_nowait()
+        except Empty:
+            try:
+                frame = await loop.run_in_executor(
+                    executor, partial(res_queue.get, True, remaining))
+            except Empty:
+                break
+        if frame is None:
+            return frames, True
+        frames.append(frame)
+        rows += RESULT_HEADER.unpack_from(frame)[1]
+    return frames, False
+
+
+def dump_failed(frame, batch):
+    # The payload is the pickled APIResult
+    with open('error-batch-{}.dump'.format(batch), 'wb') as f:
+        f.write(frame[RESULT_HEADER.size:])
+
+
+class WriterStats(object):
+    r"""
+    Rows written, transactions committed and seconds spent in transactions by
+    each DB helper process
+
+    Time spent in a transaction includes I/O, planning and triggers as well as
+    lock waits. See `LockWaits` for the time spent waiting on locks.
+    """
+
+    def __init__(self, writers):
+        self.values = RawArray('d', 3 * writers)
+
+    def __len__(self):
+        return len(self.values) // 3
+
+    def record(self, writer, rows, seconds):
+        self.values[3 * writer] += rows
+        self.values[3 * writer + 1] += 1
+        self.values[3 * writer + 2] += seconds
+
+    def totals(self):
+        r"""
+        :returns: Tuple of (rows, transactions, seconds) per writer
+        """
+        return [tuple(self.values[i:i + 3]) for i in range(0, len(self.values), 3)]
+
+
+class LockWaits(object):
+    r"""
+    Estimate how long each DB helper process waits on locks held by other
+    transactions
+
+    Every `interval` seconds, `sample` counts the connections of each process
+    that `pg_stat_activity` shows waiting on a lock. Each waiting connection
+    adds `interval` seconds to its process.
+
+    :param conn: Connection used only for sampling
+    :param int writers: Number of DB helper processes
+    """
+
+    def __init__(self, conn, writers, interval=1):
+        self.conn = conn
+        self.interval = interval
+        self.seconds = [0.0] * writers
+        self.samples = 0
+        self._sampling = False
+
+    def add(self, records):
+        for record in records:
+            if 0 <= record['writer'] < len(self.seconds):
+                self.seconds[record['writer']] += (
+                    record['waiting'] * self.interval)
+        self.samples += 1
+
+    async def sample(self):
+        # Skip a sample instead of queuing up behind a slow one
+        if self._sampling:
+            return
+        self._sampling = True
+        try:
+            self.add(await self.conn.fetch(LOCK_WAITS))
+        finally:
+            self._sampling = False
+
+
+async def write_rows(conn, write, rows, tbl, cache=None, stats=None, par=0):
+    r"""
+    Write rows in a single transaction, skipping the round trip if there is
+    nothing to write
+    """
+    if not rows:
+        return
+    # Touch index pages in order
+    rows = sorted(rows, key=itemgetter(0))
+    start = perf_counter()
+    async with conn.transaction():
+        __ = await write(conn, rows, tbl)
+    if stats is not None:
+        stats.record(par, len(rows), perf_counter() - start)
+    if cache is not None:
+        cache.update(rows)
+
+
+async def send_results_to_database(db_pool, res_queue, ack_queue, executor, par, chi, tbl='players', mode='executemany', max_rows=5000, max_age=0.5, cache=None, stats=None, targets=None, stopping=None, schema='legacy', connections=None):
+    logger = logging.getLogger('WoTServer')
+    logger.debug('Process-%i: Async-%i created', par, chi)
+    write = partial(INGEST_MODES[mode], schema=schema)
+    done = False
+    while not done:
+        if connections is not None:
+            # Idle connections are closed by the pool after a while
+            connections[par] = db_pool.get_size()
+        if targets is not None and chi >= targets[par]:
+            # Scaled down. Wait without holding a connection
+            if stopping.is_set():
+                break
+            try:
+                __ = await asyncio.wait_for(stopping.wait(), 1)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        frames, done = await collect_frames(
+            res_queue, executor, max_rows, max_age)
+        if done and stopping is not None:
+            # Pass the sentinel on to the next helper
+            stopping.set()
+            res_queue.put(None)
+        results = []
+        for frame in frames:
+            try:
+                batch, rows = unpack_rows(frame)
+            except Exception as e:
+                batch, __ = RESULT_HEADER.unpack_from(frame)
+                logger.error(
+                    'Process-%i: Async-%i could not read batch %i: %s',
+                    par,
+                    chi,
+                    batch,
+                    e)
+                dump_failed(frame, batch)
+                ack_queue.put_nowait((batch, False))
+                continue
+            if cache is not None:
+                # Players who have not played since they were last written
+                # would be discarded by the upsert anyway
+                rows = cache.changed(rows, par)
+            results.append((frame, batch, rows))
+        if not results:
+            continue
+        # Use the async here instead of before the `while` statement. Failure
+        # to do so can pin to a specific helper waiting for work instead of
+        # context switching to another that already has something to process
+        async with db_pool.acquire() as conn:
+            try:
+                __ = await write_rows(
+                    conn,
+                    write,
+                    tuple(row for __, __, rows in results for row in rows),
+                    tbl,
+                    cache,
+                    stats,
+                    par)
+                logger.debug(
+                    'Process-%i: Async-%i submitted %i batches',
+                    par,
+                    chi,
+                    len(results))
+                for __, batch, __ in results:
+                    ack_queue.put_nowait((batch, True))
+            except Exception as e:
+                logger.warning(
+                    'Process-%i: Async-%i failed to write %i batches: %s',
+                    par,
+                    chi,
+                    len(results),
+                    e)
+                # Retry each batch by itself so that one bad result does not
+                # fail the others that were written with it
+                for frame, batch, rows in results:
+                    try:
+                        __ = await write_rows(
+                            conn, write, rows, tbl, cache, stats, par)
+                        ack_queue.put_nowait((batch, True))
+                    except Exception as e:
+                        logger.error(
+                            'Process-%i: Async-%i encountered: %s',
+                            par,
+                            chi,
+                            e)
+                        dump_failed(frame, batch)
+                        ack_queue.put_nowait((batch, False))
+            if targets is not None and db_pool.get_size() > targets[par]:
+                # Scaled down during the write. Closing the connection
+                # instead of leaving it idle in the pool keeps the process
+                # within its share of the connection budget.
+                __ = await conn.close()
+    logger.debug('Process-%i: Async-%i exiting', par, chi)
+
+
+def result_handler(config, res_queue, ack_queue, par, pool_size=3, cache=None, stats=None, targets=None, connections=None):
+    logger = logging.getLogger('WoTServer')
+    mode = config.get('ingest mode', 'executemany')
+    micro = config.get('micro batch', {})
+    # Not availabile until Python 3.7. Use 3.6-compatible syntax for now
+    # asyncio.run(create_helpers(db_pool, res_queue, ack_queue))
+    logger.debug('Creating event loop')
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    # Identifies each writer in pg_stat_activity and pg_locks
+    dbconf = dict(config['database'])
+    dbconf['server_settings'] = dict(
+        dbconf.get('server_settings', {}),
+        application_name='wotserver-writer-{}'.format(par))
+    if targets is not None:
+        # Connections are only opened for active helpers. Ones above the
+        # target are closed when released, idle ones after this timeout.
+        dbconf.setdefault(
+            'max_inactive_connection_lifetime',
+            config.get('autoscale', {}).get('idle timeout', 30))
+    db_pool = loop.run_until_complete(
+        create_pool(
+            min_size=pool_size if targets is None else 0,
+            max_size=pool_size,
+            init=setup_staging if mode == 'copy' else None,
+            **dbconf))
+    logger.debug('Event loop created for Process-%i', par)
+    executor = ThreadPoolExecutor(pool_size)
+    # Set once the end of the run is signaled, to stop idle helpers
+    stopping = asyncio.Event()
+    try:
+        loop.run_until_complete(
+            asyncio.gather(*[
+                send_results_to_database(
+                    db_pool,
+                    res_queue,
+                    ack_queue,
+                    executor,
+                    par,
+                    c,
+                    'temp_players' if config.get(
+                        'use temp table', False) else 'players',
+                    mode,
+                    micro.get('rows', 5000),
+                    micro.get('age', 0.5),
+                    cache,
+                    stats,
+                    targets,
+                    stopping,
+                    config.get('schema', 'legacy'),
+                    connections)
+                for c in range(pool_size)])
+        )
+        if stats is not None:
+            rows, transactions, seconds = stats.totals()[par]
+            logger.info(
+                'Process-%i: Wrote %i rows in %i transactions, %.3f ms each',
+                par,
+                rows,
+                transactions,
+                (seconds / transactions) * 1000 if transactions else 0)
+        if cache is not None:
+            logger.info(
+                'Process-%i: %i of %i rows were unchanged',
+                par,
+                cache.counters[2 * par + 1],
+                cache.counters[2 * par])
+    finally:
+        executor.shutdown()
+        loop.close()
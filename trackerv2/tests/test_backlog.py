@@ -0,0 +1,23 @@
+from __future__ import absolute_import
+import unittest
+
+from ..server import backlog
+
+
+class TestBacklog(unittest.TestCase):
+
+    def test_watermarks(self):
+        b = backlog.Backlog({'high rows': 200, 'low rows': 100})
+        self.assertFalse(b.add(1, 100, 10))
+        self.assertTrue(b.add(2, 100, 10))
+        self.assertFalse(b.add(3, 100, 10))
+        self.assertTrue(b.throttled)
+        # Released only once the backlog is under the low watermark
+        self.assertFalse(b.remove(1))
+        self.assertTrue(b.remove(2))
+        self.assertEqual((len(b), b.rows, b.bytes), (1, 100, 10))
+        self.assertFalse(b.remove(4))
+
+
+if __name__ == '__main__':
+    unittest.main()
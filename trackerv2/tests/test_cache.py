@@ -0,0 +1,57 @@
+from __future__ import absolute_import
+import asyncio
+import unittest
+
+from ..server import cache
+
+
+class CopyConnection(object):
+
+    def __init__(self, *chunks):
+        self.chunks = chunks
+
+    async def copy_from_query(self, query, output):
+        for chunk in self.chunks:
+            await output(chunk)
+
+
+class TestBattleCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = cache.BattleCache(((5000, 5100), (90000, 90050)), 2)
+
+    def test_ranges(self):
+        self.assertEqual(len(self.cache), 150)
+        self.assertIsNone(self.cache.get(5000))
+        self.cache.set(5000, 0)
+        self.cache.set(90049, 12)
+        # Outside of every range
+        self.cache.set(6000, 1)
+        self.assertEqual(self.cache.get(5000), 0)
+        self.assertEqual(self.cache.get(90049), 12)
+        self.assertIsNone(self.cache.get(6000))
+        self.assertEqual(self.cache.battles[149], 12)
+
+    def test_changed(self):
+        self.cache.update([(5001, 'a', 10), (5002, 'b', 20)], 2)
+        rows = [(5001, 'a', 10), (5002, 'b', 21), (5003, 'c', 0)]
+        self.assertEqual(
+            self.cache.changed(rows, 1, 2),
+            ((5002, 'b', 21), (5003, 'c', 0)))
+        self.assertEqual(tuple(self.cache.counters), (0, 0, 3, 1))
+        self.assertAlmostEqual(self.cache.hit_rate(), 100 / 3)
+
+    def test_load(self):
+        conn = CopyConnection(b'5000\t4\n50', b'01\t7\n90001\t', b'9\n')
+        loop = asyncio.new_event_loop()
+        try:
+            loaded = loop.run_until_complete(self.cache.load(conn))
+        finally:
+            loop.close()
+        self.assertEqual(loaded, 3)
+        self.assertEqual(
+            [self.cache.get(a) for a in (5000, 5001, 90001)], [4, 7, 9])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+from __future__ import absolute_import
+import asyncio
+from datetime import date
+import unittest
+
+from ..server import history
+
+
+class Transaction(object):
+
+    async def __aenter__(self):
+        pass
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class HistoryConnection(object):
+
+    def __init__(self, checkpoint=None, newest=None):
+        self.checkpoint = checkpoint
+        self.newest = newest
+        self.statements = []
+
+    async def fetchval(self, query, *args):
+        if 'history_checkpoints' in query:
+            return self.checkpoint
+        return self.newest
+
+    async def execute(self, statement, *args):
+        self.statements.append((' '.join(statement.split()), args))
+        return 'INSERT 0 3'
+
+    def transaction(self):
+        return Transaction()
+
+
+class TestHistory(unittest.TestCase):
+
+    def run_async(self, coroutine):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def test_checkpoint_due(self):
+        self.assertTrue(history.checkpoint_due(None, date(2021, 3, 9)))
+        self.assertFalse(
+            history.checkpoint_due(date(2021, 3, 3), date(2021, 3, 9)))
+        self.assertTrue(
+            history.checkpoint_due(date(2021, 3, 2), date(2021, 3, 9)))
+
+    def test_write_checkpoint(self):
+        conn = HistoryConnection(date(2021, 3, 8))
+        self.assertIsNone(self.run_async(
+            history.write_checkpoint(conn, 7, date(2021, 3, 9))))
+        self.assertEqual(conn.statements, [])
+        self.assertEqual(self.run_async(
+            history.write_checkpoint(conn, 1, date(2021, 3, 9))), 3)
+        self.assertIn('FROM players', conn.statements[0][0])
+        self.assertEqual(conn.statements[1][1], (date(2021, 3, 9), 3))
+
+    def test_migrate(self):
+        # Already migrated
+        conn = HistoryConnection(date(2021, 3, 8), date(2021, 3, 9))
+        self.assertIsNone(self.run_async(history.migrate_history(conn)))
+        # Nothing to migrate
+        conn = HistoryConnection()
+        self.assertIsNone(self.run_async(history.migrate_history(conn)))
+        conn = HistoryConnection(newest=date(2021, 3, 9))
+        self.assertEqual(
+            self.run_async(history.migrate_history(conn)),
+            (date(2021, 3, 9), 3))
+        self.assertIn('DISTINCT ON (account_id)', conn.statements[0][0])
+        self.assertEqual(conn.statements[0][1], (date(2021, 3, 9),))
+
+
+if __name__ == '__main__':
+    unittest.main()
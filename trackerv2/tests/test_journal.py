@@ -0,0 +1,40 @@
+from __future__ import absolute_import
+import unittest
+import os
+from tempfile import mkdtemp
+
+from ..server import journal
+
+
+class TestCompletionJournal(unittest.TestCase):
+
+    def test_replay(self):
+        filename = os.path.join(mkdtemp(), 'journal')
+        try:
+            j = journal.CompletionJournal(filename)
+            j.append([1, 2, 3])
+            j.sync()
+            j.append([70000])
+            j.close()
+            # Simulate a torn write at the end of the journal
+            with open(filename, 'ab') as f:
+                f.write(b'\x01\x02')
+            self.assertEqual(
+                list(journal.CompletionJournal.replay(filename)),
+                [1, 2, 3, 70000])
+            j = journal.CompletionJournal(filename, resume=True)
+            j.append([4])
+            j.close()
+            self.assertEqual(
+                list(journal.CompletionJournal.replay(filename)),
+                [1, 2, 3, 70000, 4])
+            # Starting a new run discards the previous journal
+            journal.CompletionJournal(filename).close()
+            self.assertEqual(
+                list(journal.CompletionJournal.replay(filename)), [])
+        finally:
+            os.unlink(filename)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+from __future__ import absolute_import
+import asyncio
+from datetime import date
+import unittest
+
+from ..server import partitions
+
+
+class Transaction(object):
+
+    async def __aenter__(self):
+        pass
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class CatalogConnection(object):
+
+    def __init__(self, existing, archived=()):
+        self.existing = existing
+        self.archived = set(archived)
+        self.statements = []
+
+    async def fetchval(self, query, name):
+        return name if name in self.archived else None
+
+    async def fetch(self, query, table):
+        return [
+            {'relname': name} for name in self.existing
+            if name.startswith(table)]
+
+    async def execute(self, statement):
+        self.statements.append(' '.join(statement.split()))
+
+    def transaction(self):
+        return Transaction()
+
+
+class TestPartitions(unittest.TestCase):
+
+    def manage(self, conn, config):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(
+                partitions.manage_partitions(conn, config, date(2021, 3, 10)))
+        finally:
+            loop.close()
+
+    def test_names(self):
+        name = partitions.partition_name('diff_battles', date(2021, 3, 9))
+        self.assertEqual(name, 'diff_battles_2021_03_09')
+        self.assertEqual(
+            partitions.partition_day('diff_battles', name), date(2021, 3, 9))
+        self.assertIsNone(
+            partitions.partition_day('diff_battles', 'diff_battles_old'))
+
+    def test_backfill_and_archive(self):
+        conn = CatalogConnection([
+            'total_battles_2021_01_01',
+            'total_battles_2021_03_06',
+            'diff_battles_2021_03_09'])
+        created, archived = self.manage(
+            conn, {'ahead days': 1, 'retention days': 30})
+        self.assertEqual(created, [
+            'total_battles_2021_03_07',
+            'total_battles_2021_03_08',
+            'total_battles_2021_03_09',
+            'total_battles_2021_03_10',
+            'total_battles_2021_03_11',
+            'diff_battles_2021_03_10',
+            'diff_battles_2021_03_11'])
+        self.assertEqual(archived, ['total_battles_2021_01_01'])
+        self.assertIn(
+            'CREATE TABLE IF NOT EXISTS total_battles_2021_03_07 PARTITION OF '
+            "total_battles FOR VALUES FROM ('2021-03-07') TO ('2021-03-08')",
+            conn.statements)
+        self.assertIn(
+            'CREATE INDEX IF NOT EXISTS diff_battles_2021_03_09_account_id_brin '
+            'ON diff_battles_2021_03_09 USING brin (account_id)',
+            conn.statements)
+        self.assertIn(
+            'ALTER TABLE total_battles_2021_01_01 SET SCHEMA archive',
+            conn.statements)
+
+    def test_first_run(self):
+        created, archived = self.manage(
+            CatalogConnection([]), {'ahead days': 0, 'index': None})
+        self.assertEqual(created, [
+            'total_battles_2021_03_09',
+            'total_battles_2021_03_10',
+            'diff_battles_2021_03_09',
+            'diff_battles_2021_03_10'])
+        self.assertEqual(archived, [])
+
+    def test_backfill_window(self):
+        # Three weeks of downtime
+        created, __ = self.manage(
+            CatalogConnection(['total_battles_2021_02_17']),
+            {'ahead days': 0, 'backfill days': 2, 'index': None})
+        self.assertEqual(created[:3], [
+            'total_battles_2021_03_08',
+            'total_battles_2021_03_09',
+            'total_battles_2021_03_10'])
+
+    def test_archive_collision(self):
+        conn = CatalogConnection(
+            ['total_battles_2021_01_01'],
+            ['archive.total_battles_2021_01_01'])
+        __, archived = self.manage(
+            conn, {'ahead days': 0, 'retention days': 30, 'index': None})
+        self.assertEqual(archived, ['total_battles_2021_01_01_1'])
+        self.assertIn(
+            'ALTER TABLE total_battles_2021_01_01 RENAME TO '
+            'total_battles_2021_01_01_1',
+            conn.statements)
+        self.assertIn(
+            'ALTER TABLE total_battles_2021_01_01_1 SET SCHEMA archive',
+            conn.statements)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+from __future__ import absolute_import
+import asyncio
+from datetime import date
+import unittest
+
+from ..server import rollups
+
+
+class RollupConnection(object):
+
+    def __init__(self, records=()):
+        self.records = records
+        self.statements = []
+
+    async def fetch(self, query, *args):
+        self.statements.append((' '.join(query.split()), args))
+        return self.records
+
+    async def execute(self, statement, *args):
+        self.statements.append((' '.join(statement.split()), args))
+
+
+class TestRollups(unittest.TestCase):
+
+    def run_async(self, coroutine):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def test_bucket_bounds(self):
+        self.assertEqual(rollups.bucket_bounds(0), (1, 1))
+        self.assertEqual(rollups.bucket_bounds(3), (8, 15))
+
+    def test_setup_shards(self):
+        conn = RollupConnection()
+        self.run_async(rollups.setup_rollups(conn, 4))
+        function = conn.statements[2][0]
+        self.assertEqual(function.count('pg_backend_pid() % 4'), 2)
+        self.assertTrue(
+            conn.statements[-1][0].startswith('CREATE TRIGGER rollup_diffs'))
+
+    def test_fetch_histogram(self):
+        conn = RollupConnection([
+            {'console': 'ps4', 'bucket': 0, 'players': 5},
+            {'console': 'xbox', 'bucket': 0, 'players': 2},
+            {'console': 'xbox', 'bucket': 2, 'players': 7}])
+        self.assertEqual(
+            self.run_async(rollups.fetch_histogram(conn, date(2021, 3, 9))),
+            {'ps4': [(1, 1, 5)], 'xbox': [(1, 1, 2), (4, 7, 7)]})
+
+    def test_fetch_daily(self):
+        conn = RollupConnection([{'console': 'xbox', 'players': 3}])
+        day = date(2021, 3, 9)
+        self.assertEqual(
+            self.run_async(rollups.fetch_daily(conn, day)),
+            [{'console': 'xbox', 'players': 3}])
+        self.assertEqual(conn.statements[0][1], (day, day))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+from __future__ import absolute_import
+import unittest
+
+from ..server import scaling
+from ..server.writer import WriterStats
+
+
+class TestHelperScaler(unittest.TestCase):
+
+    def setUp(self):
+        self.scaler = scaling.HelperScaler(
+            {'connections': 6, 'busy frames': 10, 'max latency': 100}, 2, 2)
+
+    def test_limits(self):
+        self.assertEqual(list(self.scaler.targets), [2, 2])
+        self.assertEqual(self.scaler.max_helpers, 5)
+        # The busiest process is served first until the budget is used up
+        self.assertEqual(
+            self.scaler.decide([20, 30], [0, 0]), [(1, 2, 3), (0, 2, 3)])
+        self.scaler.targets[:] = [3, 3]
+        self.assertEqual(self.scaler.decide([100, 100], [0, 0]), [])
+
+    def test_open_connections(self):
+        # Process 0 scaled down but still has a connection open
+        self.scaler.targets[:] = [1, 2]
+        self.scaler.connections[:] = [2, 2]
+        self.assertEqual(self.scaler.committed(), 4)
+        self.assertEqual(
+            self.scaler.decide([20, 30], [0, 0]), [(1, 2, 3), (0, 1, 2)])
+        self.scaler.connections[:] = [3, 2]
+        self.assertEqual(self.scaler.decide([20, 30], [0, 0]), [(1, 2, 3)])
+
+    def test_scale_down(self):
+        # Idle, and a database that is not keeping up
+        self.assertEqual(
+            self.scaler.decide([0, 50], [0, 150]), [(1, 2, 1), (0, 2, 1)])
+        self.scaler.targets[:] = [1, 1]
+        self.assertEqual(self.scaler.decide([0, 0], [0, 0]), [])
+
+    def test_tick(self):
+        stats = WriterStats(2)
+        stats.record(0, 100, 0.5)
+        self.assertEqual(
+            self.scaler.tick([5, 25], stats), [(1, 2, 3), (0, 2, 1)])
+        self.assertEqual(list(self.scaler.targets), [1, 3])
+        self.assertEqual(len(self.scaler), 4)
+        # Latency is measured since the last decision
+        stats.record(1, 100, 0.01)
+        self.assertEqual(self.scaler.tick([5, 25], stats), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+from __future__ import absolute_import
+import asyncio
+from queue import Queue
+import unittest
+
+from ..server import server, work
+from ..server.wheel import TimingWheel
+
+
+CONFIG = {
+    'xbox': {'start account': 5000, 'max account': 5200},
+    'ps4': {'start account': 1073740000, 'max account': 1073740000}
+}
+
+
+class TestMoveToStale(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (
+            server.planner, server.leasewheel, server.server_config,
+            server.WorkWSHandler.wake)
+        self.woken = []
+        server.WorkWSHandler.wake = lambda: self.woken.append(True)
+        server.server_config = {'timeout': 40, 'speculative age': 10}
+        server.leasewheel = TimingWheel(40)
+        server.planner = work.WorkPlanner(CONFIG)
+        self.now = [100.0]
+        server.planner.clock = lambda: self.now[0]
+
+    def tearDown(self):
+        (server.planner, server.leasewheel, server.server_config,
+         server.WorkWSHandler.wake) = self.saved
+
+    def test_wake_for_speculation(self):
+        # A slow client holds the last lease, the fast one has gone idle
+        for client in ('slow', 'fast'):
+            server.leasewheel.add(server.planner.lease(client)[0])
+        server.leasewheel.discard(2)
+        server.planner.complete(2)
+        self.assertIsNone(server.planner.lease('fast'))
+        self.now[0] = 105.0
+        server.move_to_stale()
+        self.assertEqual(self.woken, [])
+        self.now[0] = 110.0
+        server.move_to_stale()
+        self.assertEqual(self.woken, [True])
+
+    def test_speculative_tail_disabled(self):
+        server.server_config['speculative tail'] = False
+        server.planner.lease('slow')
+        self.now[0] = 200.0
+        server.move_to_stale()
+        self.assertEqual(self.woken, [])
+
+
+class Helper(object):
+
+    def is_alive(self):
+        return True
+
+
+class TestTryExit(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (
+            server.workdone, server.received_queues, server.spill,
+            server.db_helpers, server.draining, server.sentinels)
+        server.workdone = [True]
+        server.spill = None
+        server.db_helpers = []
+        server.draining = False
+        server.sentinels = set()
+
+    def tearDown(self):
+        (server.workdone, server.received_queues, server.spill,
+         server.db_helpers, server.draining, server.sentinels) = self.saved
+
+    def test_full_queue(self):
+        server.received_queues = [Queue(1), Queue(1)]
+        server.received_queues[1].put(b'frame')
+        loop = asyncio.new_event_loop()
+
+        async def stop_helpers():
+            # Stop before the post-run cleanup that needs a database
+            server.db_helpers = [Helper()]
+            return await server.try_exit({}, None)
+
+        try:
+            # Does not block on the full queue
+            loop.run_until_complete(server.try_exit({}, None))
+            self.assertFalse(server.draining)
+            self.assertEqual(server.sentinels, {0})
+            server.received_queues[1].get()
+            loop.run_until_complete(stop_helpers())
+        finally:
+            loop.close()
+        self.assertTrue(server.draining)
+        self.assertEqual(
+            [queue.get_nowait() for queue in server.received_queues],
+            [None, None])
+
+
+if __name__ == '__main__':
+    unittest.main()
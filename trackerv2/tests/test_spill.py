@@ -0,0 +1,82 @@
+from __future__ import absolute_import
+import unittest
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from ..server import spill
+from ..server.backlog import Backlog
+from ..server.journal import CompletionJournal
+from ..server.utils import RESULT_HEADER
+from ..server.work import WorkPlanner
+
+
+CONFIG = {
+    'xbox': {'start account': 5000, 'max account': 5450},
+    'ps4': {'start account': 1073740000, 'max account': 1073740300}
+}
+
+
+class TestSpillBuffer(unittest.TestCase):
+
+    def test_order_and_restart(self):
+        directory = mkdtemp()
+        try:
+            buf = spill.SpillBuffer(directory, segment_size=64)
+            frames = [bytes([i]) * 40 for i in range(5)]
+            for frame in frames[:3]:
+                buf.append(frame)
+            self.assertEqual(buf.peek()[0], frames[0])
+            self.assertEqual(buf.pop(), frames[0])
+            buf.sync()
+            buf.close()
+            # Frames survive a restart. Drained frames are only removed
+            # with their segment, so the first frame is read again.
+            buf = spill.SpillBuffer(directory, segment_size=64)
+            self.assertEqual((len(buf), buf.bytes), (3, 120))
+            self.assertEqual(list(buf.frames_on_disk()), frames[:3])
+            for frame in frames[3:]:
+                buf.append(frame)
+            drained = []
+            while buf.peek() is not None:
+                drained.append(buf.pop())
+            self.assertEqual(drained, frames)
+            self.assertEqual(len(buf), 0)
+            self.assertEqual(os.listdir(directory), [])
+        finally:
+            rmtree(directory)
+
+    def test_recover_written(self):
+        directory = mkdtemp()
+        try:
+            filename = os.path.join(directory, 'journal')
+            journal = CompletionJournal(filename)
+            journal.append([2])
+            journal.close()
+            buf = spill.SpillBuffer(os.path.join(directory, 'spill'))
+            frames = [
+                RESULT_HEADER.pack(batch, 100) + b'x' * 10
+                for batch in (1, 2, 3, 1)]
+            for frame in frames:
+                buf.append(frame)
+            buf.close()
+            # Restart with --recover. Batch 2 was written before the crash
+            # but its segment had not been removed yet.
+            planner = WorkPlanner(CONFIG)
+            planner.restore(CompletionJournal.replay(filename))
+            backlog = Backlog({})
+            buf = spill.SpillBuffer(os.path.join(directory, 'spill'))
+            self.assertEqual(spill.recover_spill(buf, planner, backlog), 2)
+            self.assertEqual(sorted(backlog.pending), [1, 3])
+            self.assertEqual((len(buf), buf.bytes), (2, 2 * len(frames[0])))
+            drained = []
+            while buf.peek() is not None:
+                drained.append(buf.pop())
+            self.assertEqual(drained, [frames[0], frames[2]])
+            buf.close()
+        finally:
+            rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
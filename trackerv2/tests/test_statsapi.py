@@ -0,0 +1,115 @@
+from __future__ import absolute_import
+import asyncio
+from datetime import date
+import unittest
+
+from ..server import statsapi
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class Acquire(object):
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def __aenter__(self):
+        self.pool.acquired += 1
+        return self.pool
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class ReadPool(object):
+
+    def __init__(self, records):
+        self.records = records
+        self.acquired = 0
+
+    def acquire(self):
+        return Acquire(self)
+
+    async def fetch(self, query, *args):
+        # Let concurrent requests pile up behind the first query
+        await asyncio.sleep(0)
+        return self.records
+
+
+class TestTTLCache(unittest.TestCase):
+
+    def test_expiry(self):
+        clock = Clock()
+        cache = statsapi.TTLCache(ttl=10, clock=clock)
+        cache.put('a', 1)
+        clock.now = 9
+        self.assertEqual(cache.get('a'), 1)
+        clock.now = 10
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_lru(self):
+        cache = statsapi.TTLCache(entries=2, clock=Clock())
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+
+class TestStatsReader(unittest.TestCase):
+
+    def run_async(self, coroutine):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def test_daily(self):
+        day = date(2021, 3, 9)
+        pool = ReadPool([
+            {'_date': day, 'console': 'ps4', 'players': 2},
+            {'_date': day, 'console': 'xbox', 'players': 3}])
+        reader = statsapi.StatsReader(pool)
+
+        async def requests():
+            return await asyncio.gather(
+                *(reader.daily(day) for __ in range(3)))
+
+        responses = self.run_async(requests())
+        # One query shared by concurrent requests
+        self.assertEqual(pool.acquired, 1)
+        self.assertEqual(len(set(responses)), 1)
+        etag, body = responses[0]
+        self.assertEqual(
+            body,
+            '{"day": "2021-03-09", "consoles": {"ps4": {"players": 2}, '
+            '"xbox": {"players": 3}}}')
+        self.assertEqual(etag, statsapi.etag_of(body))
+        self.assertEqual(self.run_async(reader.daily(day)), responses[0])
+        self.assertEqual(pool.acquired, 1)
+        self.assertEqual(reader.pending, {})
+
+    def test_invalid_days(self):
+        reader = statsapi.StatsReader(ReadPool([]))
+        with self.assertRaises(ValueError):
+            self.run_async(reader.days(date(2021, 3, 9), date(2021, 3, 8)))
+        with self.assertRaises(ValueError):
+            self.run_async(reader.days(date(2020, 1, 1), date(2021, 3, 8)))
+        with self.assertRaises(ValueError):
+            statsapi.parse_day('2021-3-x')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,26 @@
+from __future__ import absolute_import
+import unittest
+
+from ..server import wheel
+
+
+class TestTimingWheel(unittest.TestCase):
+
+    def test_expiry(self):
+        w = wheel.TimingWheel(3, 1)
+        w.add(1)
+        w.tick()
+        w.add(2)
+        w.add(3)
+        self.assertTrue(w.discard(3))
+        self.assertFalse(w.discard(3))
+        expired = []
+        for __ in range(5):
+            expired.append(sorted(w.tick()))
+        # Leases never expire before the timeout has passed
+        self.assertEqual(expired, [[], [], [1], [2], []])
+        self.assertEqual(len(w), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
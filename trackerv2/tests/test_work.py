@@ -0,0 +1,226 @@
+from __future__ import absolute_import
+from datetime import datetime, timedelta
+import unittest
+
+from ..server import work
+
+
+CONFIG = {
+    'xbox': {'start account': 5000, 'max account': 5450},
+    'ps4': {'start account': 1073740000, 'max account': 1073740300}
+}
+
+
+class TestWorkPlanner(unittest.TestCase):
+
+    def test_matches_generator(self):
+        planner = work.WorkPlanner(CONFIG)
+        expected = list(work.setup_work(CONFIG))
+        self.assertEqual(len(planner), len(expected))
+        self.assertEqual(len(planner), work.calculate_total_batches(CONFIG))
+        for batch in expected:
+            self.assertEqual(planner.work(batch[0]), batch)
+
+    def test_batch_of(self):
+        planner = work.WorkPlanner(CONFIG)
+        self.assertEqual(planner.batch_of(5000), 1)
+        self.assertEqual(planner.batch_of(5449), 5)
+        self.assertEqual(planner.batch_of(1073740150), 7)
+        self.assertIsNone(planner.batch_of(6000))
+
+    def test_lease_and_complete(self):
+        planner = work.WorkPlanner(CONFIG)
+        first = planner.lease('a')
+        second = planner.lease('a')
+        self.assertEqual((first[0], second[0]), (1, 2))
+        self.assertEqual(planner.held['a'], {1, 2})
+        self.assertTrue(planner.expire(1))
+        self.assertEqual(planner.stalecount, 1)
+        # Stale work is handed out before new work
+        self.assertEqual(planner.lease('b')[0], 1)
+        self.assertTrue(planner.complete(1))
+        self.assertFalse(planner.complete(1))
+        self.assertEqual(planner.held['b'], set())
+        self.assertEqual(planner.completed, 1)
+
+    def test_seek(self):
+        planner = work.WorkPlanner(CONFIG)
+        planner.seek(6)
+        self.assertEqual(planner.completed, 5)
+        self.assertEqual(planner.lease('a')[0], 6)
+        planner.requeue(2)
+        self.assertEqual(planner.lease('a')[0], 2)
+        for batch in range(7, len(planner) + 1):
+            planner.lease('a')
+            planner.complete(batch)
+        self.assertFalse(planner.finished)
+        planner.complete(2)
+        planner.complete(6)
+        self.assertTrue(planner.finished)
+
+    def test_restore(self):
+        planner = work.WorkPlanner(CONFIG)
+        planner.restore([1, 3, 5, 500])
+        self.assertEqual(planner.written, 3)
+        self.assertEqual(
+            [planner.lease('a')[0] for __ in range(3)], [2, 4, 6])
+        planner.complete(2)
+        planner.persist(2)
+        self.assertEqual((planner.completed, planner.written), (4, 4))
+
+    def test_speculate(self):
+        planner = work.WorkPlanner(CONFIG)
+        planner.lease('a')
+        planner.lease('a')
+        planner.lease('b')
+        # Oldest lease held by another client is duplicated first
+        self.assertEqual(planner.speculate('b')[0], 1)
+        self.assertEqual(planner.speculate('b')[0], 2)
+        self.assertIsNone(planner.speculate('b'))
+        self.assertEqual(planner.speculate('a')[0], 3)
+        self.assertTrue(planner.complete(1))
+        self.assertFalse(planner.complete(1))
+        self.assertEqual(planner.held['a'], {2, 3})
+        self.assertEqual(planner.held['b'], {2, 3})
+
+    def test_last_written(self):
+        planner = work.WorkPlanner(CONFIG)
+        self.assertIsNone(planner.last_written())
+        planner.restore([3, 1])
+        self.assertEqual(planner.last_written(), 3)
+        planner.seek(planner.last_written() + 1)
+        self.assertEqual(planner.lease('a')[0], 4)
+
+    def test_speculate_limits(self):
+        planner = work.WorkPlanner(CONFIG)
+        now = [100.0]
+        planner.clock = lambda: now[0]
+        planner.lease('a')
+        planner.lease('a')
+        now[0] = 105.0
+        planner.lease('a')
+        # Leases handed out less than `min_age` seconds ago are not copied
+        self.assertEqual(planner.speculate('b', 10), None)
+        now[0] = 112.0
+        self.assertEqual(planner.speculate('b', 10)[0], 1)
+        self.assertEqual(planner.speculate('b', 10)[0], 2)
+        self.assertIsNone(planner.speculate('b', 10))
+        now[0] = 120.0
+        self.assertIsNone(planner.speculate('b', 10, limit=2))
+        self.assertEqual(planner.speculate('b', 10, limit=3)[0], 3)
+
+    def test_speculation_due(self):
+        planner = work.WorkPlanner(CONFIG)
+        now = [100.0]
+        planner.clock = lambda: now[0]
+        planner.lease('a')
+        # Work is still left to lease
+        now[0] = 120.0
+        self.assertFalse(planner.speculation_due(10))
+        while planner.lease('b') is not None:
+            pass
+        self.assertTrue(planner.speculation_due(10))
+        planner.speculate('b', 10)
+        # The only old lease is already duplicated
+        self.assertFalse(planner.speculation_due(10))
+        now[0] = 130.0
+        self.assertTrue(planner.speculation_due(10))
+
+    def test_apply_tiers(self):
+        today = datetime(2020, 1, 1)
+        tiers = {'warm period': 2, 'cold period': 3}
+        activity = [
+            {
+                0: (1, today - timedelta(days=1)),
+                1: (1, today - timedelta(days=30)),
+                2: (1, today - timedelta(days=30)),
+                3: (1, today - timedelta(days=365)),
+                4: (1, today - timedelta(days=365)),
+            },
+            {0: (1, today - timedelta(days=365))}
+        ]
+        runs = []
+        for day in range(6):
+            planner = work.WorkPlanner(CONFIG)
+            planner.apply_tiers(activity, tiers, today + timedelta(days=day))
+            runs.append(planner.skipped)
+            # Hot and unknown batches are never skipped
+            self.assertNotEqual(planner.state[1], work.SKIPPED)
+            self.assertNotEqual(planner.state[8], work.SKIPPED)
+        # Warm batches are polled every 2nd run and cold ones every 3rd
+        self.assertEqual(sum(runs), 2 * 3 + 3 * 4)
+
+    def test_sparse(self):
+        config = {
+            'xbox': {'start account': 5000, 'max account': 6000},
+            'ps4': {'start account': 1073740000, 'max account': 1073740300}
+        }
+        planner = work.WorkPlanner(config)
+        # Probe day for batch 3 only
+        today = datetime.fromordinal(30 - 3)
+        last = today - timedelta(days=1)
+        density = [{0: (60, last), 1: (30, last), 4: (50, last),
+                    5: (20, last), 6: (5, last), 7: (90, last)}, {}]
+        self.assertEqual(planner.skip_empty(density, {}, today), 1)
+        self.assertEqual(planner.state[3], work.PENDING)
+        sparse = planner.sparse_windows(
+            density, {'sparse accounts': 50}, today)
+        self.assertEqual(sparse, [[1, 4, 5, 6], []])
+        accounts = [
+            [5100 + i for i in range(30)] +
+            [5400 + i for i in range(50)] +
+            [5500 + i for i in range(20)] +
+            [5600 + i for i in range(5)],
+            []
+        ]
+        self.assertEqual(planner.pack(accounts), 2)
+        lead = planner.work(2)
+        self.assertEqual(len(lead[2]), 100)
+        self.assertEqual(lead[2][-1], 5519)
+        self.assertEqual(planner.work(7), (7, (5600, 5700)))
+        self.assertTrue(planner.complete(2))
+        self.assertEqual(planner.state[6], work.COMPLETE)
+        self.assertEqual(planner.persist(2), (2, 5, 6))
+
+    def test_frontier(self):
+        config = dict(CONFIG, frontier={'empty batches': 3})
+        planner = work.WorkPlanner(config)
+        # Batches far from the end of the range do not extend it
+        self.assertEqual(planner.observe(1, 10), ())
+        self.assertEqual(planner.observe(4, 0), ())
+        self.assertEqual(planner.observe(4, 10), (work.EXTEND, 0, 2))
+        self.assertEqual(planner.frontiers[0], 5700)
+        self.assertEqual(len(planner), 10)
+        self.assertEqual(planner.work(9), (9, (5500, 5600)))
+        self.assertEqual(planner.batch_of(5650), 10)
+        self.assertEqual(planner.observe(10, 1), (work.EXTEND, 0, 3))
+        self.assertEqual(planner.observe(7, 1), (work.EXTEND, 1, 2))
+        # Rebuild the ranges from the journal, ignoring a torn last entry
+        restored = work.WorkPlanner(config)
+        restored.restore([work.EXTEND, 0, 2, 9, work.EXTEND, 0, 3, 12,
+                          work.EXTEND, 1])
+        self.assertEqual(len(restored), 13)
+        self.assertEqual(restored.written, 2)
+        self.assertEqual(restored.work(12), (12, (5800, 5900)))
+
+    def test_chunks(self):
+        planner = work.WorkPlanner(CONFIG)
+        planner.extend(0, 1)
+        # Chunks do not cross segments
+        self.assertEqual(list(planner.chunks(2)), [
+            (1, 3, (5000, 5200)),
+            (3, 5, (5200, 5400)),
+            (5, 6, (5400, 5500)),
+            (6, 8, (1073740000, 1073740200)),
+            (8, 9, (1073740200, 1073740300)),
+            (9, 10, (5500, 5600))])
+        planner.skip(1)
+        self.assertFalse(planner.settled(1, 3))
+        planner.complete(planner.lease('a')[0])
+        self.assertFalse(planner.settled(1, 3))
+        planner.persist(2)
+        self.assertTrue(planner.settled(1, 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
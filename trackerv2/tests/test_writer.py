@@ -0,0 +1,93 @@
+from __future__ import absolute_import
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+import unittest
+
+from ..server import writer
+from ..server.utils import RESULT_HEADER
+
+
+def frame(batch, players):
+    return RESULT_HEADER.pack(batch, players)
+
+
+class TestCollectFrames(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(1)
+        self.queue = Queue()
+
+    def tearDown(self):
+        self.executor.shutdown()
+        self.loop.close()
+
+    def collect(self, max_rows=250, max_age=0.05):
+        return self.loop.run_until_complete(writer.collect_frames(
+            self.queue, self.executor, max_rows, max_age))
+
+    def test_row_limit(self):
+        for batch in range(1, 5):
+            self.queue.put(frame(batch, 100))
+        frames, done = self.collect()
+        self.assertEqual(
+            [RESULT_HEADER.unpack(f)[0] for f in frames], [1, 2, 3])
+        self.assertFalse(done)
+
+    def test_age_limit(self):
+        self.queue.put(frame(1, 100))
+        frames, done = self.collect()
+        self.assertEqual(len(frames), 1)
+        self.assertFalse(done)
+
+    def test_sentinel(self):
+        self.queue.put(frame(1, 100))
+        self.queue.put(None)
+        self.assertEqual(self.collect(), ([frame(1, 100)], True))
+        self.queue.put(None)
+        self.assertEqual(self.collect(), ([], True))
+
+
+class TestWriterStats(unittest.TestCase):
+
+    def test_record(self):
+        stats = writer.WriterStats(2)
+        stats.record(1, 100, 0.5)
+        stats.record(1, 50, 0.25)
+        self.assertEqual(len(stats), 2)
+        self.assertEqual(stats.totals(), [(0, 0, 0), (150, 2, 0.75)])
+
+
+class TestLockWaits(unittest.TestCase):
+
+    def test_sample(self):
+        class Connection(object):
+            async def fetch(self, query, *args):
+                return [{'writer': 1, 'waiting': 2}, {'writer': 5, 'waiting': 1}]
+
+        waits = writer.LockWaits(Connection(), 2, 0.5)
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(waits.sample())
+            loop.run_until_complete(waits.sample())
+        finally:
+            loop.close()
+        # Writers of another server sharing the database are ignored
+        self.assertEqual(waits.seconds, [0.0, 2.0])
+        self.assertEqual(waits.samples, 2)
+
+
+class TestSplitRows(unittest.TestCase):
+
+    def test_columns(self):
+        row = (1, 'nick', 10.0, 20.0, 30.0, 5, 'xbox', 6, 7, 8, 9, 10, 40.0)
+        self.assertEqual(
+            writer.identity_rows([row]), ((1, 'nick', 'xbox', 10.0),))
+        self.assertEqual(
+            writer.counter_rows([row]),
+            ((1, 20.0, 30.0, 5, 6, 7, 8, 9, 10, 40.0),))
+
+
+if __name__ == '__main__':
+    unittest.main()